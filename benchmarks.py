@@ -0,0 +1,829 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from filetools.title import (Title, clean, parse_many, match_queries, QuerySet,
+        SearchTimer, _clean_cache)
+
+
+NAMES = ['movie name', 'show name', 'the other show', 'my movie', 'anime name',
+        'some long movie title with words', '4.44 last day on earth',
+        'artist name - album name', 'naruto shippuuden', 'le grand film']
+EPISODES = ['', '', 's01e02', 's12e10', '3x02', '302', 'part 2', '- 261']
+YEARS = ['', '', '1998', '2012', '(2011)']
+RIPS = ['', 'DVDRip XviD', 'HDTV XviD', 'BRRip x264 AC3', '720p HDTV x264',
+        'LIMITED BDRip XviD', 'PROPER 1080p BluRay x264', 'VODRiP XViD AC3',
+        'FRENCH DVDRip XviD', 'VOSTFR HDTV', 'MULTi 1080p WEBRip', '[480p]']
+TEAMS = ['', '-TEAM', '-LOL', '-MAJESTiC', ' [TEAM]']
+SEPS = [' ', '.', '_']
+
+
+def get_corpus(count=3000, seed=0):
+    '''Get a reproducible list of release names.
+    '''
+    rand = random.Random(seed)
+    res = []
+    for i in range(count):
+        words = [rand.choice(NAMES), rand.choice(EPISODES),
+                rand.choice(YEARS), rand.choice(RIPS)]
+        sep = rand.choice(SEPS)
+        val = sep.join([w.replace(' ', sep) for w in words if w])
+        res.append(val + rand.choice(TEAMS))
+    return res
+
+def run(name, callable, corpus, repeat=3):
+    '''Print the best rate of the repeats.
+
+    The title caches are cleared before each repeat,
+    so that the repeats do not measure cache hits.
+    '''
+    best = None
+    for i in range(repeat):
+        _clean_cache.clear()
+        Title.cache.clear()
+        begin = time.time()
+        for val in corpus:
+            callable(val)
+        duration = time.time() - begin
+        if best is None or duration < best:
+            best = duration
+    print('%-30s %10.1f titles/s' % (name, len(corpus) / best))
+
+def bench_title(corpus):
+    run('Title', Title, corpus)
+
+def bench_title_tokens(corpus):
+    run('Title(engine=tokens)', lambda v: Title(v, engine='tokens'), corpus)
+
+def bench_title_parse(corpus):
+    run('Title.parse', Title.parse, corpus)
+    print('%-30s %s' % ('Title.cache', Title.cache.info()))
+
+def bench_parse_many(corpus):
+    corpus = ['%s %d' % (v, i) for i in range(10) for v in corpus]    # defeat the cache
+    for workers in (1, 2, 4):
+        Title.cache.clear()
+        begin = time.time()
+        for res in parse_many(corpus, workers=workers):
+            pass
+        print('%-30s %10.1f titles/s' % ('parse_many(workers=%d)' % workers,
+                len(corpus) / (time.time() - begin)))
+
+def bench_match_queries(corpus, count=300):
+    queries = sorted(set([Title.parse(v).display_name for v in corpus]))[:count]
+    corpus = corpus[:300]
+    for cached in (False, True):
+        begin = time.time()
+        for val in corpus:
+            if not cached:
+                Title.search_cache.clear()
+            match_queries(val, queries)
+        print('%-30s %10.1f titles/s' % ('match_queries(%d, cached=%s)' % (len(queries), cached),
+                len(corpus) / (time.time() - begin)))
+
+def bench_query_set(corpus):
+    rand = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    corpus = corpus[:300]
+    for count in (100, 1000, 10000):
+        queries = list(NAMES)
+        while len(queries) < count:
+            queries.append(' '.join([''.join(rand.sample(letters, rand.randint(3, 8)))
+                    for i in range(rand.randint(1, 4))]))
+        query_set = QuerySet(queries)
+        begin = time.time()
+        for val in corpus:
+            query_set.match(val)
+        print('%-30s %10.1f titles/s' % ('QuerySet(%d)' % count,
+                len(corpus) / (time.time() - begin)))
+
+def bench_clean(corpus, siblings=30):
+    # Media._has_unrelated compares each sibling name with the media name
+    names = [Title.parse(v).display_name for v in corpus[:siblings]]
+    calls = []
+    for name in names:
+        for name_ in names:
+            calls += [name_, name]
+    run('clean(level=9) siblings', lambda v: clean(v, 9), calls)
+    print('%-30s %s' % ('clean cache', _clean_cache.info()))
+
+def get_fuzz_titles(length, seed=0):
+    '''Get titles with long separators runs and repeated junk.
+    '''
+    rand = random.Random(seed)
+    chunks = [' ', '.', '_', '-', '.s', 's.', ' the', '[a]', '(b)', '0', '9', 'x']
+    prefixes = ['show', 'show name', 'show name 1x23', 'anime name 123', 'the show name']
+    res = []
+    for prefix in prefixes:
+        for chunk in chunks:
+            res.append((prefix + chunk * length)[:length])
+        for i in range(10):
+            val = prefix
+            while len(val) < length:
+                val += rand.choice(chunks)
+            res.append(val[:length])
+    return res
+
+def bench_search_fuzz(corpus):
+    queries = ['show name', 'show name 1x23', 'show name 123', 'the show name']
+    for safe, lengths in ((False, (20, 40, 60)), (True, (40, 80, 160, 320, 640, 1280))):
+        for length in lengths:
+            timer = SearchTimer()
+            for mode in (None, '__all__'):
+                query_set = QuerySet(queries, mode=mode, safe=safe, timer=timer)
+                for val in get_fuzz_titles(length):
+                    query_set.match(val)
+            pattern, stat = timer.get_slowest(limit=1)[0]
+            print('%-30s %10.4f s max (%r)' % ('search(safe=%s, chars=%d)' % (safe, length),
+                    stat['max'], stat['slowest'][:30]))
+
+class SyscallCounter(object):
+    '''Count the stat and directory listing calls made through os
+    and the scandir DirEntry objects.
+
+    :param latency: delay added to each call (s), to simulate a network file system
+    '''
+    NAMES = ['stat', 'lstat', 'listdir']
+
+    def __init__(self, module, latency=0):
+        self.module = module
+        self.latency = latency
+        self.count = 0
+        self.orig = {}
+
+    def call(self):
+        self.count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _wrap(self, func):
+        def wrapper(*args, **kwargs):
+            self.call()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def _scandir(self, path):
+        self.call()
+        return [CountingDirEntry(e, self) for e in self.orig['scandir'](path)]
+
+    def __enter__(self):
+        for name in self.NAMES:
+            self.orig[name] = getattr(os, name)
+            setattr(os, name, self._wrap(self.orig[name]))
+        if hasattr(self.module, 'scandir'):
+            self.orig['scandir'] = self.module.scandir
+            self.module.scandir = self._scandir
+        return self
+
+    def __exit__(self, *args):
+        for name in self.NAMES:
+            setattr(os, name, self.orig[name])
+        if 'scandir' in self.orig:
+            self.module.scandir = self.orig['scandir']
+
+
+class CountingDirEntry(object):
+
+    def __init__(self, dir_entry, counter):
+        self.dir_entry = dir_entry
+        self.counter = counter
+        self.name = dir_entry.name
+        self.path = dir_entry.path
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self.counter.call()
+            self._stat = self.dir_entry.stat()
+        return self._stat
+
+    def is_dir(self):
+        return self.dir_entry.is_dir()
+
+    def is_file(self):
+        return self.dir_entry.is_file()
+
+    def is_symlink(self):
+        return self.dir_entry.is_symlink()
+
+# Captured "mediainfo -language=raw -f" output of a tv episode
+MEDIAINFO_CAPTURE = '''General
+Count : 292
+Count of stream of this kind : 1
+Kind of stream : General
+Stream identifier : 0
+Unique ID : 221496226597421438219617839376329372766
+Complete name : /data/Show Name/Season 1/show.name.s01e02.720p.hdtv.x264-team.mkv
+Folder name : /data/Show Name/Season 1
+File name : show.name.s01e02.720p.hdtv.x264-team
+File extension : mkv
+Format : Matroska
+Format : Matroska
+Format/Url : http://packs.matroska.org/
+Format/Extensions usually used : mkv mk3d mka mks
+Commercial name : Matroska
+Format version : Version 2
+Codecs Video : V_MPEG4/ISO/AVC
+Audio codecs : AC-3 / AAC
+Video_Format_List : AVC
+Video_Format_WithHint_List : AVC
+Audio_Format_List : AC-3 / AAC
+Audio_Format_WithHint_List : AC-3 / AAC
+Audio_Language_List : English / French
+Text_Format_List : UTF-8
+Text_Language_List : English
+File size : 1153572211
+File size : 1.07 GiB
+File size : 1 GiB
+File size : 1.1 GiB
+File size : 1.07 GiB
+File size : 1.074 GiB
+Duration : 2602368
+Duration : 43mn 22s
+Duration : 43mn 22s 368ms
+Duration : 43mn 22s
+Duration : 00:43:22.368
+Duration : 00:43:22;09
+Duration : 00:43:22.368 (00:43:22;09)
+Overall bit rate mode : VBR
+Overall bit rate mode : Variable
+Overall bit rate : 3546191
+Overall bit rate : 3 546 Kbps
+Frame rate : 23.976
+Frame rate : 23.976 fps
+Frame count : 62394
+Stream size : 10214432
+Stream size : 9.74 MiB (1%)
+Proportion of this stream : 0.00885
+Title : Show Name S01E02
+Movie name : Show Name S01E02
+Performer : Artist Name
+Album : Album Name
+Recorded date : 2012
+Track name : Episode Title
+Track name/Position : 2
+Encoded date : UTC 2012-03-04 05:06:07
+File last modification date : UTC 2012-03-04 05:16:07
+File last modification date (local) : 2012-03-04 06:16:07
+Writing application : mkvmerge v5.0.1 ('Die Wiederkehr') built on Oct  9 2011 11:55:43
+Writing library : libebml v1.2.2 + libmatroska v1.3.0
+IsTruncated : No
+
+Video
+Count : 334
+Count of stream of this kind : 1
+Kind of stream : Video
+Stream identifier : 0
+StreamOrder : 0
+ID : 1
+Unique ID : 1
+Format : AVC
+Format/Info : Advanced Video Codec
+Format/Url : http://developers.videolan.org/x264.html
+Commercial name : AVC
+Format profile : High@L4.1
+Format settings, CABAC : Yes
+Format settings, ReFrames : 4 frames
+Internet media type : video/H264
+Codec ID : V_MPEG4/ISO/AVC
+Codec ID/Url : http://ffdshow-tryout.sourceforge.net/
+Codec : V_MPEG4/ISO/AVC
+Codec/Family : AVC
+Codec/Info : Advanced Video Codec
+Duration : 2602352
+Duration : 43mn 22s
+Duration : 00:43:22.352
+Bit rate : 3142568
+Bit rate : 3 143 Kbps
+Width : 1280
+Width : 1 280 pixels
+Height : 720
+Height : 720 pixels
+Sampled_Width : 1280
+Sampled_Height : 720
+Pixel aspect ratio : 1.000
+Display aspect ratio : 1.778
+Display aspect ratio : 16:9
+Frame rate mode : CFR
+Frame rate mode : Constant
+Frame rate : 23.976
+Frame rate : 23.976 (24000/1001) fps
+Frame count : 62394
+Color space : YUV
+Chroma subsampling : 4:2:0
+Bit depth : 8
+Bit depth : 8 bits
+Scan type : Progressive
+Bits/(Pixel*Frame) : 0.142
+Stream size : 1022149120
+Stream size : 975 MiB (89%)
+Writing library : x264 - core 120 r2120 0c7dab9
+Encoding settings : cabac=1 / ref=4 / deblock=1:0:0 / analyse=0x3:0x113 / me=umh / subme=9 / psy=1 / psy_rd=1.00:0.00 / mixed_ref=1 / me_range=16 / chroma_me=1 / trellis=2 / 8x8dct=1 / cqm=0 / deadzone=21,11 / fast_pskip=1 / chroma_qp_offset=-2 / threads=12 / sliced_threads=0 / nr=0 / decimate=1 / interlaced=0
+Language : en
+Language : English
+Default : Yes
+Forced : No
+
+Audio #1
+Count : 272
+Count of stream of this kind : 2
+Kind of stream : Audio
+Stream identifier : 0
+StreamOrder : 1
+ID : 2
+Unique ID : 2
+Format : AC-3
+Format/Info : Audio Coding 3
+Commercial name : Dolby Digital
+Codec ID : A_AC3
+Codec : AC3
+Codec/Family : AC3
+Duration : 2602368
+Duration : 43mn 22s
+Bit rate mode : CBR
+Bit rate mode : Constant
+Bit rate : 384000
+Bit rate : 384 Kbps
+Channel(s) : 6
+Channel(s) : 6 channels
+Channel positions : Front: L C R, Side: L R, LFE
+Sampling rate : 48000
+Sampling rate : 48.0 KHz
+Samples count : 124913664
+Bit depth : 16
+Compression mode : Lossy
+Delay relative to video : 0
+Stream size : 124913664
+Stream size : 119 MiB (11%)
+Language : en
+Language : English
+Default : Yes
+Forced : No
+
+Audio #2
+Count : 272
+Count of stream of this kind : 2
+Kind of stream : Audio
+Stream identifier : 1
+StreamOrder : 2
+ID : 3
+Format : AAC
+Format/Info : Advanced Audio Codec
+Codec ID : A_AAC
+Codec : AAC LC
+Duration : 2602368
+Bit rate : 128000
+Bit rate : 128 Kbps
+Channel(s) : 2
+Sampling rate : 48000
+Language : fr
+Language : French
+Default : No
+Forced : No
+
+Text
+Count : 283
+Count of stream of this kind : 1
+Kind of stream : Text
+Stream identifier : 0
+ID : 4
+Format : UTF-8
+Codec ID : S_TEXT/UTF8
+Codec ID/Info : UTF-8 Plain Text
+Codec : S_TEXT/UTF8
+Codec/Info : UTF-8 Plain Text
+Language : en
+Language : English
+Default : No
+Forced : No
+
+Menu
+Count : 92
+Count of stream of this kind : 1
+Kind of stream : Menu
+00:00:00.000 : en:Chapter 1
+00:10:12.345 : en:Chapter 2
+00:21:34.567 : en:Chapter 3
+00:32:45.678 : en:Chapter 4
+'''
+
+FILE_EXTS = ['.avi', '.mkv', '.srt', '.nfo', '.rar', '.mp3', '.jpg']
+
+def make_files(path, corpus, count, offset=0, size=0):
+    '''Create files named after the corpus.
+
+    :param size: max file size (KB)
+    '''
+    for i in range(offset, offset + count):
+        file = '%s.%d%s' % (corpus[i % len(corpus)], i, FILE_EXTS[i % len(FILE_EXTS)])
+        with open(os.path.join(path, file), 'w') as fd:
+            fd.write('x' * (i % (size + 1)) * 1024)
+
+def make_tree(path, corpus, count):
+    for i in range(0, count, 100):
+        dir = os.path.join(path, corpus[i / 100 % len(corpus)], str(i))
+        os.makedirs(dir)
+        make_files(dir, corpus, min(100, count - i), offset=i)
+
+def bench_files(corpus, count=100000):
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, corpus, count)
+        with SyscallCounter(media) as counter:
+            begin = time.time()
+            res = sum(1 for f in media.files(path))
+            duration = time.time() - begin
+        print('%-30s %10.1f files/s %6.2f syscalls/file' % ('files(%d)' % res,
+                res / duration, counter.count / float(res)))
+    finally:
+        shutil.rmtree(path)
+
+def bench_files_parallel(corpus, count=5000, latency=0.001):
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, corpus, count)
+        for workers, ordered in ((None, True), (4, True), (16, True), (16, False)):
+            with SyscallCounter(media, latency=latency):
+                begin = time.time()
+                res = sum(1 for f in media.files(path, workers=workers, ordered=ordered))
+                duration = time.time() - begin
+            print('%-30s %10.1f files/s' % ('files(workers=%s%s)' % (workers,
+                    '' if ordered else ', unordered'), res / duration))
+    finally:
+        shutil.rmtree(path)
+
+def bench_files_filter(corpus, count=50000):
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, corpus, count)
+        for name, kwargs in (
+                ('re_ext=mkv', {'re_ext': re.compile(r'mkv', re.I)}),
+                ('re_ext=mkv, size_max=1', {'re_ext': re.compile(r'mkv', re.I), 'size_max': 1}),
+                ('types=video', {'types': 'video'}),
+                ):
+            with SyscallCounter(media) as counter:
+                begin = time.time()
+                res = sum(1 for f in media.files(path, **kwargs))
+                duration = time.time() - begin
+            print('%-30s %10.1f files/s %6.2f syscalls/file' % ('files(%s)' % name,
+                    count / duration, counter.count / float(count)))
+    finally:
+        shutil.rmtree(path)
+
+def bench_get_type(corpus, depth=4, width=4, count=20):
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        dirs = [path]
+        level = [path]
+        for i in range(depth):
+            level = [os.path.join(d, 'dir%d' % j) for d in level for j in range(width)]
+            dirs += level
+        for i, dir in enumerate(dirs):
+            if dir != path:
+                os.makedirs(dir)
+            make_files(dir, corpus, count, offset=i * count, size=8)
+
+        for name in ('cold', 'warm'):
+            with SyscallCounter(media) as counter:
+                begin = time.time()
+                for dir in dirs:
+                    media.get_type(dir)
+                duration = time.time() - begin
+            print('%-30s %10.1f dirs/s %8.1f syscalls/dir' % ('get_type(%d dirs, %s)' % (len(dirs), name),
+                    len(dirs) / duration, counter.count / float(len(dirs))))
+    finally:
+        shutil.rmtree(path)
+
+def bench_file_objects(corpus, count=50000):
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, corpus, count)
+        entries = list(media.iter_entries(path))
+        begin = time.time()
+        res = [media.get_file(e) for e in entries]
+        exts = [f.ext for f in res]
+        duration = time.time() - begin
+        size = sum(sys.getsizeof(f) + (sys.getsizeof(f.__dict__) if hasattr(f, '__dict__') else 0)
+                for f in res)
+        print('%-30s %10.1f files/s %8.1f bytes/file' % ('get_file(%d).ext' % len(res),
+                len(res) / duration, size / float(len(res))))
+    finally:
+        shutil.rmtree(path)
+
+def bench_file_type(corpus, count=20000):
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, corpus, count)
+        entries = list(media.iter_entries(path))
+        run('get_file_type', media.get_file_type, entries)
+        run('get_file_type(sniff=True)', lambda e: media.get_file_type(e, sniff=True), entries)
+    finally:
+        shutil.rmtree(path)
+
+def bench_file_info(corpus, count=20000):
+    from filetools import media
+
+    calls = []
+    def get_info(file):
+        calls.append(file)  # stands for a mediainfo process
+        return {}
+
+    path = tempfile.mkdtemp()
+    get_info_orig = media.get_info
+    media.get_info = get_info
+    try:
+        make_tree(path, corpus, count)
+        media.Media.set_info_index(os.path.join(path, 'index.db'))
+        for name in ('cold', 'warm'):
+            del calls[:]
+            begin = time.time()
+            res = 0
+            for file in media.files(path, types=media.Media.TYPES):
+                file.get_file_info()
+                res += 1
+            print('%-30s %10.1f files/s %8d mediainfo calls' % ('get_file_info(%d, %s)' % (res, name),
+                    res / (time.time() - begin), len(calls)))
+    finally:
+        media.get_info = get_info_orig
+        media.Media.set_info_index(None)
+        shutil.rmtree(path)
+
+@contextmanager
+def mediainfo_stub(count):
+    '''Get media files with a mediainfo stub binary in the PATH.
+    '''
+    from tests import make_mediainfo_stub, make_media_files
+
+    path = tempfile.mkdtemp()
+    path_env = os.environ['PATH']
+    try:
+        make_mediainfo_stub(path)
+        os.environ['PATH'] = '%s:%s' % (path, path_env)
+        yield make_media_files(path, count)
+    finally:
+        os.environ['PATH'] = path_env
+        shutil.rmtree(path)
+
+def bench_mediainfo(corpus, count=500):
+    from filetools import mediainfo
+
+    with mediainfo_stub(count) as files:
+        begin = time.time()
+        for file in files:
+            mediainfo.get_info(file)
+        print('%-30s %10.1f files/s' % ('get_info', count / (time.time() - begin)))
+
+        for batch_size in (10, 50, 200):
+            begin = time.time()
+            mediainfo.get_info_many(files, batch_size=batch_size)
+            print('%-30s %10.1f files/s' % ('get_info_many(batch_size=%d)' % batch_size,
+                    count / (time.time() - begin)))
+
+def bench_mediainfo_concurrent(corpus, count=100, delay=0.05):
+    '''Simulate mediainfo processes waiting on I/O for delay seconds.
+    '''
+    from filetools import mediainfo
+
+    os.environ['MEDIAINFO_STUB_DELAY'] = str(delay)
+    try:
+        with mediainfo_stub(count) as files:
+            begin = time.time()
+            for file in files:
+                mediainfo.get_info(file)
+            print('%-30s %10.1f files/s' % ('get_info', count / (time.time() - begin)))
+
+            for max_workers in (2, 4, 8):
+                begin = time.time()
+                for file, info in mediainfo.get_info_concurrent(files, max_workers=max_workers):
+                    pass
+                print('%-30s %10.1f files/s' % ('get_info_concurrent(%d)' % max_workers,
+                        count / (time.time() - begin)))
+    finally:
+        del os.environ['MEDIAINFO_STUB_DELAY']
+
+def bench_mediainfo_parser(corpus, count=2000):
+    from filetools.mediainfo import _parse_lines, _get_info
+
+    lines = [l + '\n' for l in MEDIAINFO_CAPTURE.splitlines()]
+    for name, kwargs in [('_parse_lines', {}), ('_parse_lines(fields=None)', {'fields': None})]:
+        begin = time.time()
+        for i in range(count):
+            for data in _parse_lines(lines, **kwargs):
+                _get_info(data)
+        print('%-30s %10.1f outputs/s' % (name, count / (time.time() - begin)))
+
+def bench_open_files(corpus, count=40, files_count=10):
+    '''Check a downloads directory of count items for open files.
+    '''
+    from filetools import media
+
+    path = tempfile.mkdtemp()
+    try:
+        for i in range(count):
+            os.makedirs(os.path.join(path, str(i)))
+            make_files(os.path.join(path, str(i)), corpus, files_count, offset=i * files_count)
+        items = [os.path.join(path, str(i)) for i in range(count)]
+
+        begin = time.time()
+        for item in items:
+            media.is_file_open(item, check_mtime=False)
+        print('%-30s %10.3f s' % ('is_file_open(%d)' % count, time.time() - begin))
+
+        begin = time.time()
+        media.get_open(items, check_mtime=False)
+        print('%-30s %10.3f s' % ('get_open(%d)' % count, time.time() - begin))
+
+        begin = time.time()
+        media.get_open(items, mtime_delta=1)
+        print('%-30s %10.3f s' % ('get_open(%d, mtime_delta=1)' % count, time.time() - begin))
+    finally:
+        shutil.rmtree(path)
+
+def bench_watch_downloads(corpus, count=20, quiet_delay=1):
+    '''Measure the pickup latency and CPU usage of the downloads watcher.
+    '''
+    import threading
+    from filetools import download
+
+    path = tempfile.mkdtemp()
+    try:
+        watch = download.watch_downloads(path, quiet_delay=quiet_delay)
+        timers = []
+        for i in range(count):
+            file = os.path.join(path, 'item%d' % i, '%s.mkv' % corpus[i])
+            def write(file=file):
+                os.makedirs(os.path.dirname(file))
+                with open(file, 'w') as fd:
+                    fd.write('data')
+            timers.append(threading.Timer(i * .1, write))
+        begin = time.time()
+        cpu_begin = time.clock()
+        for timer in timers:
+            timer.start()
+        latencies = []
+        for i in range(count):
+            next(watch)
+            latencies.append(time.time() - begin - i * .1)
+        cpu = time.clock() - cpu_begin
+        print('%-30s %10.3f s (quiet_delay=%s)' % ('pickup latency max',
+                max(latencies), quiet_delay))
+        print('%-30s %10.3f s for %.1f s' % ('cpu', cpu, time.time() - begin))
+        watch.close()
+    finally:
+        shutil.rmtree(path)
+
+def bench_downloads(corpus, count=12, tracks=5, delay=0.05):
+    '''Process audio album downloads, with mediainfo processes
+    waiting on I/O for delay seconds.
+    '''
+    from tests import MEDIAINFO_OUTPUT
+    from filetools import download
+
+    os.environ['MEDIAINFO_STUB_DELAY'] = str(delay)
+    try:
+        with mediainfo_stub(0) as files:
+            for workers in (1, 2, 4, 8):
+                path = tempfile.mkdtemp()
+                try:
+                    items = []
+                    for i in range(count):
+                        items.append(os.path.join(path, 'album %d' % i))
+                        os.makedirs(items[-1])
+                        for j in range(tracks):
+                            with open(os.path.join(items[-1], 'track %d.mp3' % j), 'w') as fd:
+                                fd.write((MEDIAINFO_OUTPUT % {'duration': 60000}
+                                        ).replace('Album Name', 'Album %d' % i))
+
+                    begin = time.time()
+                    res = sum(1 for f in download.process_downloads(items, workers,
+                            info_workers=workers))
+                    print('%-30s %10.1f items/s' % ('process_downloads(%d)' % workers,
+                            res / (time.time() - begin)))
+                finally:
+                    shutil.rmtree(path)
+    finally:
+        del os.environ['MEDIAINFO_STUB_DELAY']
+
+def bench_unpack(corpus, count=50, size=1024):
+    '''Extract zip and tar.gz archives of count members of size KB.
+    '''
+    import zipfile
+    import tarfile
+    from StringIO import StringIO
+    from filetools import media
+
+    rand = random.Random(0)
+    data = [''.join(rand.choice('abcdefgh') for i in range(1024)) * size for i in range(4)]
+    path = tempfile.mkdtemp()
+    try:
+        file_zip = os.path.join(path, 'archive.zip')
+        with zipfile.ZipFile(file_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(count):
+                zf.writestr('dir/file%d' % i, data[i % len(data)])
+        file_tar = os.path.join(path, 'archive.tar.gz')
+        tf = tarfile.open(file_tar, 'w:gz')
+        for i in range(count):
+            info = tarfile.TarInfo('dir/file%d' % i)
+            info.size = len(data[i % len(data)])
+            tf.addfile(info, StringIO(data[i % len(data)]))
+        tf.close()
+
+        for name, func in [
+                ('unzip', lambda: media.popen(media.ARCHIVE_DEF['.zip'] + [file_zip], cwd=path)),
+                ('unpack_zip', lambda: media.unpack_zip(file_zip, path)),
+                ('unpack_tar', lambda: media.unpack_tar(file_tar, path)),
+                ]:
+            begin = time.time()
+            func()
+            duration = time.time() - begin
+            print('%-30s %10.1f MB/s' % (name, count * size / 1024.0 / duration))
+    finally:
+        shutil.rmtree(path)
+
+def bench_unpack_download(corpus, count=2000, archives=20):
+    '''Unpack a download of count files and archives containing an archive.
+    '''
+    import zipfile
+    from StringIO import StringIO
+    from filetools import download
+
+    buf = StringIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr('file.txt', 'data')
+    nested = buf.getvalue()
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, corpus, count)
+        for path_, dirs, files in os.walk(path):    # no unrar needed
+            for file in files:
+                if file.endswith('.rar'):
+                    os.remove(os.path.join(path_, file))
+        for i in range(archives):
+            with zipfile.ZipFile(os.path.join(path, 'archive%d.zip' % i), 'w') as zf:
+                zf.writestr('archive%d/nested.zip' % i, nested)
+
+        with SyscallCounter(download.media) as counter:
+            begin = time.time()
+            download.unpack_download(path)
+            duration = time.time() - begin
+        print('%-30s %10.3f s %10d syscalls' % ('unpack_download(%d, %d)' % (count, archives),
+                duration, counter.count))
+    finally:
+        shutil.rmtree(path)
+
+
+BENCHMARKS = [
+    bench_title,
+    bench_title_tokens,
+    bench_title_parse,
+    bench_clean,
+    bench_parse_many,
+    bench_match_queries,
+    bench_query_set,
+    bench_search_fuzz,
+    bench_files,
+    bench_files_parallel,
+    bench_files_filter,
+    bench_get_type,
+    bench_file_objects,
+    bench_file_type,
+    bench_file_info,
+    bench_mediainfo,
+    bench_mediainfo_concurrent,
+    bench_mediainfo_parser,
+    bench_open_files,
+    bench_watch_downloads,
+    bench_downloads,
+    bench_unpack,
+    bench_unpack_download,
+    ]
+
+
+def main(names=None):
+    corpus = get_corpus()
+    for bench in BENCHMARKS:
+        if not names or bench.__name__ in names:
+            bench(corpus)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,57 +1,219 @@
 import os
 import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import threading
 import logging
 
 from filetools import media
+from filetools.inotify import (Inotify, IN_CLOSE_WRITE, IN_MOVED_TO,
+        IN_CREATE, IN_ONLYDIR, IN_ISDIR, IN_Q_OVERFLOW)
 
 
 RE_DOWNLOAD_JUNK = re.compile(r'/(\.DS_Store|Thumbs\.db)$', re.I)
-UNPACK_PASSES = 3
 SIZE_ALBUM_IMAGE_MIN = 50     # KB
+UNPACK_WORKERS = 2    # downloads unpacking at once
+UNPACK_PASSES = 3   # unused, nested archives are unpacked at any depth
+INFO_WORKERS = 4    # mediainfo processes at once
+WATCH_QUIET_DELAY = 10    # seconds without events before processing a download
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
 
 logger = logging.getLogger(__name__)
 
 
-def downloads(path):
+def downloads(path, workers=None, unpack_workers=UNPACK_WORKERS,
+        info_workers=INFO_WORKERS):
     '''Iterate processed downloads.
+
+    :param workers: number of downloads directory items processed
+        concurrently (see process_downloads())
     '''
     if not os.path.exists(path):
         logger.error('%s does not exist', path)
         return
 
-    for file in media.iter_files(path, incl_dirs=True, recursive=False):
-        if media.is_file_open(file):
-            continue
+    files = list(media.iter_files(path, incl_dirs=True, recursive=False))
+    open_files = media.get_open(files)
+    files = [f for f in files if f not in open_files]
+    if workers and workers > 1:
+        for res in process_downloads(files, workers,
+                unpack_workers=unpack_workers, info_workers=info_workers):
+            yield res
+    else:
+        for file in files:
+            for res in process_download(file):
+                yield res
+
+@contextmanager
+def _slot(semaphore):
+    if semaphore is None:
+        yield
+    else:
+        with semaphore:
+            yield
+
+def process_download(file, unpack_slots=None, info_slots=None):
+    '''Unpack, clean and iterate the downloads of a downloads directory item.
+
+    :param unpack_slots: semaphore limiting the concurrent unpacks
+    :param info_slots: semaphore limiting the concurrent mediainfo processes
+    '''
+    with _slot(unpack_slots):
         file = unpack_download(file)
-        for res in get_downloads(file):
-            res = clean_download_dir(res)
-            if res:
-                yield media.File(res)
+    for res in get_downloads(file, info_slots=info_slots):
+        res = clean_download_dir(res)
+        if res:
+            yield media.File(res)
+
+def _process_download_safe(args):
+    file, unpack_slots, info_slots = args
+    try:
+        return list(process_download(file, unpack_slots, info_slots))
+    except Exception:
+        logger.exception('failed to process download %s', file)
+        return []
+
+def process_downloads(files, workers, unpack_workers=UNPACK_WORKERS,
+        info_workers=INFO_WORKERS):
+    '''Process downloads directory items concurrently
+    and iterate the downloads of each item as it finishes.
+
+    A failing item is logged and does not stop the other items.
+
+    :param workers: number of items processed at once
+    :param unpack_workers: number of items unpacking at once
+    :param info_workers: number of mediainfo processes at once
+    '''
+    unpack_slots = threading.BoundedSemaphore(unpack_workers)
+    info_slots = threading.BoundedSemaphore(info_workers)
+    pool = ThreadPool(workers)
+    try:
+        for res in pool.imap_unordered(_process_download_safe,
+                [(f, unpack_slots, info_slots) for f in files]):
+            for file in res:
+                yield file
+    finally:
+        pool.terminate()
+
+def _get_item(path_root, file):
+    '''Get the downloads directory item containing the file.
+    '''
+    rel_path = os.path.relpath(file, path_root)
+    if rel_path.startswith(os.pardir) or rel_path == os.curdir:
+        return
+    return os.path.join(path_root, rel_path.split(os.sep)[0])
+
+def _add_watches(inotify, path):
+    for dir in [path] + list(media.iter_files(path, incl_files=False, incl_dirs=True)):
+        try:
+            inotify.add_watch(dir, WATCH_MASK)
+        except Exception as e:
+            logger.debug('failed to watch %s: %s', dir, str(e))
 
-def unpack_download(download, passes=UNPACK_PASSES):
-    '''Move download file into a directory and unpack the archives.
+def watch_downloads(path, quiet_delay=WATCH_QUIET_DELAY):
+    '''Watch the downloads directory with inotify and iterate
+    processed downloads (see downloads()).
 
+    Items are processed once they got no written, moved or created
+    file for quiet_delay seconds and have no open file.
+    Items existing when the watch starts are processed first.
+
+    :param quiet_delay: delay without events before processing an item (seconds)
+    '''
+    if not os.path.exists(path):
+        logger.error('%s does not exist', path)
+        return
+
+    inotify = Inotify()
+    pending = {}    # item: last event time
+
+    def handle_events(events, ignored=()):
+        now = time.time()
+        for path_event, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.info('inotify queue overflow, rescanning %s', path)
+                _add_watches(inotify, path)
+                for item in media.iter_files(path, incl_dirs=True, recursive=False):
+                    pending[item] = now
+                continue
+            if path_event is None:
+                continue
+            file = os.path.join(path_event, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                _add_watches(inotify, file)
+            item = _get_item(path, file)
+            if item and item not in ignored:
+                pending[item] = now
+
+    try:
+        _add_watches(inotify, path)
+        for item in media.iter_files(path, incl_dirs=True, recursive=False):
+            pending[item] = 0
+
+        while True:
+            now = time.time()
+            items = [i for i, t in pending.items() if now - t >= quiet_delay]
+            if items:
+                open_files = media.get_open(items, check_mtime=False)
+                for item in sorted(items):
+                    if item in open_files:
+                        pending[item] = now
+                        continue
+                    del pending[item]
+                    if not os.path.exists(item):
+                        continue
+                    processed = set([item])
+                    for res in process_download(item):
+                        processed.add(_get_item(path, res.file))
+                        yield res
+                    # Ignore the events caused by the processing
+                    while True:
+                        events = inotify.read(0)
+                        if not events:
+                            break
+                        handle_events(events, ignored=processed)
+
+            timeout = None
+            if pending:
+                timeout = max(0, min(pending.values()) + quiet_delay - time.time())
+            handle_events(inotify.read(timeout))
+    finally:
+        inotify.close()
+
+def unpack_download(download, passes=None):
+    '''Move download file into a directory and unpack the archives,
+    including the archives extracted from other archives.
+
+    :param passes: unused, kept for compatibility
     :return: directory
     '''
     download = media.clean_file(download, strip_extra=True)
     if os.path.isfile(download):
         # Move file into a directory
-        path_dst = media.get_unique(os.path.splitext(download)[0])
-        path, filename, ext = media.fsplit(download)
-        file_dst = media.rename_file(download,
-                os.path.join(path_dst, filename + ext))
+        with media.rename_lock:
+            path_dst = media.get_unique(os.path.splitext(download)[0])
+            path, filename, ext = media.fsplit(download)
+            file_dst = media.rename_file(download,
+                    os.path.join(path_dst, filename + ext))
         download = os.path.dirname(file_dst)
 
-    to_skip = []
-    for i in range(passes):
-        for file in sorted(list(media.iter_files(download))):  # sort for multipart archives
-            if file in to_skip:
-                continue
-            res = media.get_file(file)
-            if res.type == 'archive':
-                to_skip += res.unpack(remove_src=True)
-            else:
-                to_skip.append(file)
+    # Sort for multipart archives
+    queue = deque(sorted([e.file for e in media.iter_entries(download)
+            if media.get_file_type(e) == 'archive']))
+    processed = set()
+    while queue:
+        file = queue.popleft()
+        if file in processed or not os.path.exists(file):
+            continue
+        extracted = []
+        archive = media.get_file(file)
+        processed.add(file)
+        processed.update(archive.unpack(remove_src=True,
+                progress=lambda file_, *args: extracted.append(file_)))
+        queue.extend(sorted([f for f in extracted if f not in processed
+                and media.get_file_type(f) == 'archive']))
 
     return download
 
@@ -73,9 +235,10 @@ def clean_download_dir(path):
     if os.path.exists(path):
         return path
 
-def get_downloads(path_root):
+def get_downloads(path_root, info_slots=None):
     '''Clean and get download sub directories.
 
+    :param info_slots: semaphore limiting the concurrent mediainfo processes
     :return: directories list
     '''
     paths = []
@@ -88,7 +251,8 @@ def get_downloads(path_root):
             for file in media.files(path, recursive=False):
                 # Get album files
                 if file.type == 'audio' and file.ext.lower() not in ('.m3u',):
-                    album[file.file] = file.get_file_info()
+                    with _slot(info_slots):
+                        album[file.file] = file.get_file_info()
                 # Get extra files
                 elif file.type == 'video' or (file.type == 'image' \
                         and media.get_size(file.file) > SIZE_ALBUM_IMAGE_MIN):
@@ -0,0 +1,94 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+EVENT_STRUCT = struct.Struct('iIII')    # wd, mask, cookie, name length
+READ_SIZE = 65536
+
+
+class InotifyError(Exception): pass
+
+
+def _get_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError) as e:
+        raise InotifyError('inotify is not available: %s' % str(e))
+    return libc
+
+
+class Inotify(object):
+    '''Linux inotify instance.
+    '''
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise InotifyError('failed to init inotify: %s' % os.strerror(ctypes.get_errno()))
+        self.watches = {}   # watch descriptor: path
+
+    def add_watch(self, path, mask):
+        '''Watch a directory.
+
+        :return: watch descriptor
+        '''
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise InotifyError('failed to watch %s: %s' % (path, os.strerror(ctypes.get_errno())))
+        self.watches[wd] = path
+        return wd
+
+    def remove_watch(self, wd):
+        if self.watches.pop(wd, None) is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        '''Read the pending events, waiting at most timeout seconds
+        for the first one (None to wait forever).
+
+        :return: list of (path, mask, name)
+        '''
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+            data = os.read(self.fd, READ_SIZE)
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        res = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_STRUCT.unpack_from(data, pos)
+            pos += EVENT_STRUCT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            res.append((self.watches.get(wd), mask, name))
+        return res
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
@@ -2,14 +2,26 @@ import os
 import re
 from datetime import datetime
 import shutil
-from stat import S_IMODE
+from stat import S_IMODE, S_ISDIR, S_ISREG
 import mimetypes
 import filecmp
 import time
 import tempfile
-from contextlib import contextmanager
+import zipfile
+import tarfile
+import zlib
+import threading
+from contextlib import contextmanager, closing
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from collections import deque
 import logging
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 from lxml import html
 
 import pexpect
@@ -17,8 +29,9 @@ import pexpect
 from systools.system import popen
 
 from filetools.title import Title, clean, PATTERN_EXTRA
-from filetools.utils import in_range, compare_words
-from filetools.mediainfo import get_info
+from filetools.utils import in_range, compare_words, LRUCache, PersistentCache
+from filetools.mediainfo import (get_info, get_info_concurrent,
+        MEDIAINFO_WORKERS, MEDIAINFO_TIMEOUT)
 
 
 RE_TVSHOW_CHECK = re.compile(r'[\W_]s\d{2}e\d{2}[\W_]', re.I)
@@ -29,13 +42,64 @@ RE_EXTRACT_ERRORS = {
     '.zip': re.compile(r'\b(signature\snot\sfound|unsupported\scompression\smethod)\b', re.I),
     '.rar': re.compile(r'\bCorrupt\sfile\sor\swrong\spassword\b', re.I),
     }
+RE_EXTRACTED_FILE = {
+    '.zip': re.compile(r'^\s*(?:inflating|extracting):\s+(.+?)\s*$'),
+    '.rar': re.compile(r'^Extracting\s+(.+?)\s+OK\s*$'),
+    '.7z': re.compile(r'^(?:Extracting\s+(?!archive:)|-\s)(.+?)\s*$'),
+    }
+RE_EXTRACT_PROGRESS = re.compile(r'\x08+(?:\s*\d+%)?')   # e.g.: unrar "\b\b\b\b 55%"
+RE_ARCHIVE_MEMBER = {
+    '.zip': re.compile(r'^(.+)$'),
+    '.rar': re.compile(r'^(.+)$'),
+    '.7z': re.compile(r'^Path = (.+)$'),
+    }
 SIZE_TVSHOW_MAX = 600   # for tvshow detection (MB)
+PROC_PATH = '/proc'
+DIR_TYPES_CACHE_SIZE = 10000
+WALK_PENDING_PER_WORKER = 4    # directory listings submitted and not consumed yet
+INFO_INDEX_VERSION = 1     # bump to invalidate the stored file info
 ARCHIVE_DEF = {
     '.zip': ['unzip', '-o'],    # overwrite files
     '.rar': ['unrar', 'x', '-yo+', '-p-'],  # assume yes to all questions, overwrite files, do not query password
     '.7z': ['7za', 'x', '-y'],  # assume yes to all questions
     # '.ace': ['unace', 'x', '-y'], # assume yes to all questions
     }
+ARCHIVE_LIST_DEF = {
+    '.zip': ['unzip', '-Z1'],   # member names only
+    '.rar': ['unrar', 'lb', '-p-'],     # member names only, do not query password
+    '.7z': ['7za', 'l', '-slt'],    # technical listing, a "Path = " line per member
+    }
+TAR_EXTS = ('.tar', '.tgz', '.tbz2')    # and .tar.gz, .tar.bz2 through mimetypes
+TAR_MIME_TYPE = 'application/x-tar'
+ARCHIVE_EXTS = list(ARCHIVE_DEF) + list(TAR_EXTS) + ['.gz', '.bz2']
+UNPACK_BUFFER_SIZE = 1024 * 1024
+UNPACK_READ_ERRORS = (zipfile.BadZipfile, tarfile.TarError, zlib.error,
+        EOFError, IOError)
+ZIP_COMPRESS_TYPES = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)    # supported by zipfile
+SUBTITLES_EXTS = ('.srt', '.ssa', '.sub')
+CUSTOM_TYPES = dict([(ext, 'archive') for ext in list(ARCHIVE_DEF) + list(TAR_EXTS)]
+        + [(ext, 'subtitles') for ext in SUBTITLES_EXTS])
+mimetypes.init()
+MIME_TYPES = dict([(ext, mime.split('/')[0]) for ext, mime in mimetypes.types_map.items()])
+MAGIC_SIZE = 16
+MAGIC_TYPES = [     # offset, magic number, type
+    (0, '\x1a\x45\xdf\xa3', 'video'),     # matroska, webm
+    (8, 'AVI ', 'video'),
+    (4, 'ftypM4A', 'audio'),
+    (4, 'ftyp', 'video'),   # mp4, mov
+    (0, '\x00\x00\x01\xba', 'video'),     # mpeg program stream
+    (0, 'ID3', 'audio'),
+    (0, '\xff\xfb', 'audio'),     # mp3
+    (0, 'fLaC', 'audio'),
+    (0, 'OggS', 'audio'),
+    (8, 'WAVE', 'audio'),
+    (0, 'Rar!\x1a\x07', 'archive'),
+    (0, 'PK\x03\x04', 'archive'),
+    (0, '7z\xbc\xaf\x27\x1c', 'archive'),
+    (0, '\x89PNG', 'image'),
+    (0, '\xff\xd8\xff', 'image'),    # jpeg
+    (0, 'GIF8', 'image'),
+    ]
 RE_RAR_PASSWORD = re.compile(r'\bEnter password.*for.*:\W*', re.I)
 RE_ZIP_PASSWORD = re.compile(r'\bpassword:\W*', re.I)
 PATTERNS_LANGS_WORDS = {
@@ -52,33 +116,294 @@ PATTERNS_LANGS_WORDS = {
 
 logger = logging.getLogger(__name__)
 
+_unset = object()
 
-def iter_files(path_root, incl_files=True, incl_dirs=False, topdown=False, recursive=True):
-    '''Iterate files in the root path.
+
+class Entry(object):
+    '''File or directory with cached stat info.
+
+    :param file: file or directory
+    :param dir_entry: DirEntry object from scandir()
+    '''
+    __slots__ = ['file', 'dir_entry', '_stat']
+
+    def __init__(self, file, dir_entry=None):
+        self.file = file
+        self.dir_entry = dir_entry
+        self._stat = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.file)
+
+    def __reduce__(self):
+        # DirEntry objects cannot be pickled, the stat info is not kept
+        return self.__class__, (self.file,)
+
+    def stat(self):
+        '''Get the stat result, following symlinks.
+
+        :raise OSError: if the file does not exist
+        '''
+        if self._stat is None:
+            if self.dir_entry is not None:
+                self._stat = self.dir_entry.stat()
+            else:
+                self._stat = os.stat(self.file)
+        return self._stat
+
+    def exists(self):
+        try:
+            self.stat()
+        except OSError:
+            return False
+        return True
+
+    def is_dir(self):
+        try:
+            if self.dir_entry is not None:
+                return self.dir_entry.is_dir()
+            return S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            if self.dir_entry is not None:
+                return self.dir_entry.is_file()
+            return S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        if self.dir_entry is not None:
+            return self.dir_entry.is_symlink()
+        return os.path.islink(self.file)
+
+
+def get_entry(file):
+    '''Get an Entry object from a file or an Entry object.
+    '''
+    if isinstance(file, Entry):
+        return file
+    return Entry(file)
+
+def _scandir(path):
+    '''Get the directories and other entries in the path.
+    '''
+    dirs, nondirs = [], []
+    try:
+        for dir_entry in scandir(path):
+            entry = Entry(dir_entry.path, dir_entry)
+            if entry.is_dir():
+                dirs.append(entry)
+            else:
+                nondirs.append(entry)
+    except OSError:
+        pass
+    return dirs, nondirs
+
+def _walk(path, topdown=False):
+    '''Walk the directory tree like os.walk() without following symlinks.
+    '''
+    dirs, nondirs = _scandir(path)
+    if topdown:
+        yield path, dirs, nondirs
+    for dir in dirs:
+        if not dir.is_symlink():
+            for res in _walk(dir.file, topdown=topdown):
+                yield res
+    if not topdown:
+        yield path, dirs, nondirs
+
+def _scandir_prefetch(path):
+    '''List the path and prefetch the stat info of its files.
+
+    :return: (dirs, nondirs, subdirs to walk)
+    '''
+    dirs, nondirs = _scandir(path)
+    for entry in nondirs:
+        entry.exists()
+    return dirs, nondirs, [dir for dir in dirs if not dir.is_symlink()]
+
+
+class _WalkNode(object):
+    '''Directory of an ordered parallel walk.
+    '''
+    __slots__ = ['path', 'res', 'listing', 'children']
+
+    def __init__(self, path):
+        self.path = path
+        self.res = None         # listing result if submitted
+        self.listing = None     # (dirs, nondirs) once listed
+        self.children = None
+
+    def expand(self):
+        '''Get the listing, waiting for it if submitted,
+        listing the directory in this thread otherwise.
+        '''
+        if self.listing is None:
+            if self.res is None:
+                dirs, nondirs, subdirs = _scandir_prefetch(self.path)
+            else:
+                dirs, nondirs, subdirs = self.res.get()
+            self.listing = dirs, nondirs
+            self.children = [_WalkNode(d.file) for d in subdirs]
+        return self.listing
+
+    def iter_listed(self):
+        '''Iterate the node and, if listed, its descendants in walk order
+        (without waiting for any listing).
+        '''
+        yield self
+        if self.res is not None and self.res.ready():
+            self.expand()
+        if self.children is not None:
+            for child in self.children:
+                for node in child.iter_listed():
+                    yield node
+
+
+def _walk_ordered(path, pool, max_pending, topdown=False):
+    '''Walk the directory tree in the same order as _walk(),
+    submitting the listings of the next max_pending directories
+    in walk order among the known ones.
+    '''
+    frames = []     # [children, index of the child being walked]
+    stat = {'pending': 0}   # listings submitted and not walked yet
+
+    def submit_next():
+        for children, i in reversed(frames):
+            for child in children[i + 1:]:
+                for node in child.iter_listed():
+                    if node.res is None and node.listing is None:
+                        if stat['pending'] >= max_pending:
+                            return
+                        node.res = pool.apply_async(_scandir_prefetch, (node.path,))
+                        stat['pending'] += 1
+
+    def walk(node):
+        if node.res is not None:
+            stat['pending'] -= 1
+        dirs, nondirs = node.expand()
+        node.res = None
+        frames.append([node.children, -1])
+        submit_next()
+        if topdown:
+            yield node.path, dirs, nondirs
+        for i, child in enumerate(node.children):
+            frames[-1][1] = i
+            for res in walk(child):
+                yield res
+        frames.pop()
+        # Release the walked listings
+        node.listing = node.children = None
+        if not topdown:
+            yield node.path, dirs, nondirs
+
+    return walk(_WalkNode(path))
+
+def _scandir_async(path, pool, slots, queue):
+    '''List the path, prefetch the stat info of its files, submit the
+    listing of its subdirectories while slots are available and queue
+    the listing with the subdirectories not submitted.
+    '''
+    try:
+        dirs, nondirs, subdirs = _scandir_prefetch(path)
+    except Exception as e:
+        queue.put(e)
+        return
+
+    submitted = [slots.acquire(False) for dir in subdirs]
+    # Queue the listing before its subdirectories listings
+    deferred = [d for d, s in zip(subdirs, submitted) if not s]
+    queue.put((path, dirs, nondirs, deferred, sum(submitted)))
+    for dir, s in zip(subdirs, submitted):
+        if s:
+            pool.apply_async(_scandir_async, (dir.file, pool, slots, queue))
+
+def _walk_parallel(path, workers, topdown=False, ordered=True):
+    '''Walk the directory tree listing directories in a thread pool.
+
+    At most WALK_PENDING_PER_WORKER * workers listings are submitted
+    and not walked at once, so a slow caller does not get the whole
+    tree listed in memory.
+
+    :param ordered: yield the directories in the same order as _walk(),
+        otherwise yield them as soon as they are listed (parents
+        are still listed before their subdirectories)
+    '''
+    max_pending = WALK_PENDING_PER_WORKER * workers
+    pool = ThreadPool(workers)
+    try:
+        if ordered:
+            for res in _walk_ordered(path, pool, max_pending, topdown=topdown):
+                yield res
+        else:
+            slots = threading.BoundedSemaphore(max_pending)
+            queue = Queue()
+            deferred = deque([path])
+            pending = 0
+            while pending or deferred:
+                while deferred and slots.acquire(False):
+                    pool.apply_async(_scandir_async, (deferred.popleft(), pool, slots, queue))
+                    pending += 1
+                res = queue.get()
+                slots.release()
+                if isinstance(res, Exception):
+                    raise res
+                path_, dirs, nondirs, deferred_, count = res
+                deferred.extend([d.file for d in deferred_])
+                pending += count - 1
+                yield path_, dirs, nondirs
+    finally:
+        pool.terminate()
+
+def iter_entries(path_root, incl_files=True, incl_dirs=False, topdown=False,
+        recursive=True, workers=None, ordered=True):
+    '''Iterate files in the root path and yield Entry objects.
+
+    :param workers: number of threads listing the directories in parallel
+        (e.g.: for network file systems)
+    :param ordered: with workers, keep the sequential walk order
     '''
-    if not os.path.exists(path_root):
+    root = get_entry(path_root)
+    if not root.exists():
         logger.error('%s does not exist', path_root)
-    elif os.path.isfile(path_root):
+    elif root.is_file():
         if incl_files:
-            yield path_root
+            yield root
     elif recursive:
-        for path, dirs, files in os.walk(path_root, topdown=topdown):
+        if workers and workers > 1:
+            walk = _walk_parallel(root.file, workers, topdown=topdown, ordered=ordered)
+        else:
+            walk = _walk(root.file, topdown=topdown)
+        for path, dirs, files in walk:
             if incl_dirs:
                 for dir in dirs:
-                    yield os.path.join(path, dir)
+                    yield dir
             if incl_files:
                 for file in files:
-                    yield os.path.join(path, file)
+                    yield file
     else:
-        for file in os.listdir(path_root):
-            file = os.path.join(path_root, file)
-            if (incl_dirs and os.path.isdir(file)) \
-                    or (incl_files and os.path.isfile(file)):
-                yield file
+        for dir_entry in scandir(root.file):
+            entry = Entry(dir_entry.path, dir_entry)
+            if (incl_dirs and entry.is_dir()) \
+                    or (incl_files and entry.is_file()):
+                yield entry
+
+def iter_files(path_root, incl_files=True, incl_dirs=False, topdown=False,
+        recursive=True, workers=None, ordered=True):
+    '''Iterate files in the root path.
+    '''
+    for entry in iter_entries(path_root, incl_files=incl_files,
+            incl_dirs=incl_dirs, topdown=topdown, recursive=recursive,
+            workers=workers, ordered=ordered):
+        yield entry.file
 
 def get_file(file, real_file=None):
     '''Get a File object.
 
+    :param file: file or Entry object
     :param real_file: real file
     '''
     cl_default = File
@@ -93,34 +418,100 @@ def get_file(file, real_file=None):
         return cl(file, real_file=real_file)
     return cl_default(file)
 
+def _get_filters(re_file=None, re_path=None, re_filename=None, re_ext=None,
+        size_min=None, size_max=None, types=None):
+    '''Get the files() filters ordered by cost: regexes on the path
+    first, then the size (stat) and the type (which walks the directories).
+
+    :return: list of callables taking an Entry object
+    '''
+    filters = []
+    if re_file:
+        filters.append(lambda entry: re_file.search(entry.file))
+
+    if re_path or re_filename or re_ext:
+        def check_names(entry):
+            path, filename, ext = fsplit(entry)
+            if re_path and not re_path.search(path):
+                return False
+            elif re_filename and not re_filename.search(filename):
+                return False
+            elif re_ext and not re_ext.search(ext):
+                return False
+            return True
+
+        filters.append(check_names)
+
+    if size_min or size_max:
+        def check_entry_size(entry):
+            try:
+                return check_size(entry, size_min, size_max)
+            except OSError as e:
+                logger.debug('failed to get %s size: %s', entry.file, str(e))
+
+        filters.append(check_entry_size)
+
+    if types:
+        if not isinstance(types, (list, tuple)):
+            types = [types]
+        filters.append(lambda entry: get_type(entry) in types)
+
+    return filters
+
 def files(path_root, re_file=None, re_path=None, re_filename=None, re_ext=None,
             size_min=None, size_max=None, incl_files=True, incl_dirs=False,
-            types=None, topdown=False, recursive=True):
+            types=None, topdown=False, recursive=True, workers=None, ordered=True):
     '''Iterate files and yield File objects according to the file type.
+
+    File objects are only created for the entries matching the filters.
+
+    :param path_root: path or Entry object
+    :param workers: number of threads walking the directories (see iter_entries())
+    :param ordered: with workers, keep the sequential walk order
     '''
-    if not os.path.exists(path_root):
-        logger.error('%s does not exist', path_root)
+    root = get_entry(path_root)
+    if not root.exists():
+        logger.error('%s does not exist', root.file)
     else:
-        for file in iter_files(path_root, incl_files=incl_files,
-                incl_dirs=incl_dirs, topdown=topdown, recursive=recursive):
-            if types:
-                if not isinstance(types, (list, tuple)):
-                    types = [types]
-                if not get_type(file) in types:
-                    continue
+        filters = _get_filters(re_file=re_file, re_path=re_path,
+                re_filename=re_filename, re_ext=re_ext,
+                size_min=size_min, size_max=size_max, types=types)
+        for entry in iter_entries(root, incl_files=incl_files,
+                incl_dirs=incl_dirs, topdown=topdown, recursive=recursive,
+                workers=workers, ordered=ordered):
+            for filter in filters:
+                if not filter(entry):
+                    break
+            else:
+                yield get_file(entry)
 
-            res = get_file(file)
-            if re_file and not re_file.search(res.file):
-                continue
-            elif re_path and not re_path.search(res.path):
-                continue
-            elif re_filename and not re_filename.search(res.filename):
-                continue
-            elif re_ext and not re_ext.search(res.ext):
-                continue
-            elif not check_size(res.file, size_min, size_max):
-                continue
-            yield res
+def get_files_info(files, max_workers=MEDIAINFO_WORKERS, timeout=MEDIAINFO_TIMEOUT):
+    '''Get the info of media files, running mediainfo concurrently
+    for the files missing from the info index.
+
+    :param files: Media objects (e.g.: from files(path, types=Media.TYPES))
+    :param max_workers: maximum number of mediainfo processes
+    :param timeout: timeout of each mediainfo process (seconds)
+    :return: iterator of (Media object, info) in completion order,
+        the info of the files mediainfo failed on is not stored in the info index
+    '''
+    files = list(files)
+    index = Media.info_index
+    if index:
+        infos = index.get_many([f.entry for f in files])
+        for file in files:
+            if file.file in infos:
+                yield file, infos[file.file]
+        files = [f for f in files if f.file not in infos]
+
+    files_dict = dict([(f.file, f) for f in files])
+    for file, media_info in get_info_concurrent(files_dict.keys(),
+            max_workers=max_workers, timeout=timeout):
+        file = files_dict[file]
+        info = file._get_file_info(media_info or {})
+        if index and media_info is not None:
+            index.set(file.entry, info)
+        yield file, info
 
 @contextmanager
 def mkdtemp(path, prefix='tmp_'):
@@ -133,18 +524,22 @@ def mkdtemp(path, prefix='tmp_'):
 def fsplit(file):
     '''Get the path, filename (without path and extension) and extension of a file.
 
+    :param file: file or Entry object
     :return: tuple
     '''
-    path, file_ = os.path.split(file)
+    entry = get_entry(file)
+    path, file_ = os.path.split(entry.file)
     filename, ext = os.path.splitext(file_)
-    if (os.path.exists(file) and os.path.isdir(file)) or (not os.path.exists(file) and len(ext)) > 4:
+    if entry.is_dir() or (len(ext) > 4 and not entry.exists()):
         filename, ext = file_, ''
     return path, filename, ext
 
 def get_size(file):
     '''Get file size (KB).
+
+    :param file: file or Entry object
     '''
-    return os.stat(file).st_size / 1024.0
+    return get_entry(file).stat().st_size / 1024.0
 
 def check_size(file, size_min=None, size_max=None):
     '''Check file size (MB).
@@ -153,19 +548,51 @@ def check_size(file, size_min=None, size_max=None):
     if size is not None:
         return in_range(size / 1024, size_min, size_max)
 
-def get_file_type(file):
+def sniff_file_type(file):
+    '''Get the file type from its first bytes (magic numbers).
+    '''
+    try:
+        with open(file, 'rb') as fd:
+            data = fd.read(MAGIC_SIZE)
+    except (IOError, OSError):
+        return None
+    for offset, magic, file_type in MAGIC_TYPES:
+        if data[offset:offset + len(magic)] == magic:
+            return file_type
+
+def get_file_type(file, sniff=False):
+    '''Get the file type from its extension.
+
+    :param file: file or Entry object
+    :param sniff: first check the file content magic numbers
+        (e.g.: for files without or with a wrong extension)
+    '''
+    entry = get_entry(file)
+    is_dir = entry.is_dir()
+    if sniff and not is_dir:
+        file_type = sniff_file_type(entry.file)
+        if file_type:
+            return file_type
+
+    ext = os.path.splitext(entry.file)[1]
+
     # Custom types
-    if not os.path.isdir(file):
-        ext = os.path.splitext(file)[1].lower()
-        if ext in ARCHIVE_DEF:
+    if not is_dir:
+        file_type = CUSTOM_TYPES.get(ext.lower())
+        if file_type:
+            return file_type
+
+    # Compressed files extensions need the mimetypes suffixes handling
+    if ext in mimetypes.suffix_map or ext in mimetypes.encodings_map \
+            or ext.lower() in mimetypes.encodings_map:
+        file_type = mimetypes.guess_type(entry.file)[0]
+        if file_type == TAR_MIME_TYPE:
             return 'archive'
-        elif ext in ('.srt', '.ssa', '.sub'):
-            return 'subtitles'
+        elif file_type:
+            file_type = file_type.split('/')[0]
+        return file_type
 
-    file_type = mimetypes.guess_type(file)[0]
-    if file_type:
-        file_type = file_type.split('/')[0]
-    return file_type
+    return MIME_TYPES.get(ext) or MIME_TYPES.get(ext.lower())
 
 def get_mtime(file):
     try:
@@ -174,19 +601,61 @@ def get_mtime(file):
         return
     return datetime.utcfromtimestamp(date)
 
+_dir_types_cache = LRUCache(DIR_TYPES_CACHE_SIZE)
+
+def _get_dir_type_stat(entry):
+    '''Get the type stat of the files in the directory tree.
+
+    The stat of the files directly in a directory is cached
+    until the directory modified time changes, so only the
+    modified directories of the tree are listed again.
+
+    :param entry: directory Entry object
+    :return: dict of type: [number of files, size (KB)]
+    '''
+    try:
+        mtime = entry.stat().st_mtime
+    except OSError:
+        return {}
+
+    cached = _dir_types_cache.get(entry.file)
+    if cached and cached[0] == mtime:
+        subdirs = [Entry(d) for d in cached[2]]
+        type_stat = cached[1]
+    else:
+        dirs, nondirs = _scandir(entry.file)
+        subdirs = [d for d in dirs if not d.is_symlink()]
+        type_stat = {}
+        for res in nondirs:
+            file_type = get_file_type(res)
+            if file_type:
+                try:
+                    size = res.stat().st_size / 1024
+                except OSError:
+                    continue
+                type_stat.setdefault(file_type, [0, 0])
+                type_stat[file_type][0] += 1
+                type_stat[file_type][1] += size
+        _dir_types_cache.set(entry.file, (mtime, type_stat, [d.file for d in subdirs]))
+
+    res = dict([(t, list(v)) for t, v in type_stat.items()])
+    for subdir in subdirs:
+        for file_type, (count, size) in _get_dir_type_stat(subdir).items():
+            res.setdefault(file_type, [0, 0])
+            res[file_type][0] += count
+            res[file_type][1] += size
+    return res
+
 def get_type(file):
     '''Get the file type or the main file type in the directory.
+
+    :param file: file or Entry object
     '''
-    if not os.path.isdir(file):
-        return get_file_type(file)
+    entry = get_entry(file)
+    if not entry.is_dir():
+        return get_file_type(entry)
 
-    type_stat = {}
-    for res in files(file):
-        file_type = get_file_type(res.file)
-        if file_type:
-            type_stat.setdefault(file_type, [0, 0])
-            type_stat[file_type][0] += 1
-            type_stat[file_type][1] += os.stat(res.file).st_size / 1024
+    type_stat = _get_dir_type_stat(entry)
     # Main type has the greatest 'size' * 'number of files'
     stat = sorted([(v[0] * v[1], t) for t, v in type_stat.items()])
     if stat:
@@ -197,8 +666,14 @@ def get_permissions(file):
     '''
     return oct(S_IMODE(os.stat(file).st_mode))
 
+# Serializes picking a unique name and renaming to it: downloads
+# cleaned concurrently (e.g. "Movie Name.mkv" and "Movie&Name.mkv")
+# would otherwise get the same destination
+rename_lock = threading.RLock()
+
 def get_unique(file):
     '''Get a unique file or directory name.
+    The caller should hold rename_lock until the name is used.
 
     :param file: file or directory
     '''
@@ -230,20 +705,98 @@ def clean_file(file, strip_extra=False):
     file_dst = os.path.join(path, filename + ext)
     if file_dst != file:
         # Rename file
-        if os.path.exists(file_dst):
-            file_dst = get_unique(file_dst)
         file_dst = rename_file(file, file_dst)
     return file_dst
 
 def rename_file(file, file_dst):
     if file_dst != file:
-        file_dst = get_unique(file_dst)
+        with rename_lock:
+            file_dst = get_unique(file_dst)
+            try:
+                os.renames(file, file_dst)
+            except OSError:
+                logger.exception('exception')
+                return file
+    return file_dst
+
+def get_open_files():
+    '''Get the files open by any process, in a single pass
+    over /proc/*/fd or with a single lsof call if /proc is not available.
+
+    :return: set of real paths
+    '''
+    res = set()
+    if not os.path.isdir(PROC_PATH):
+        stdout, stderr, return_code = popen(['lsof', '-F', 'n'])
+        # lsof exits with 1 on partial errors (e.g.: permission denied)
+        if return_code is None or (return_code != 0 and not stdout):
+            logger.error('failed to get the open files with lsof: %s', stderr)
+            return res
+        for line in stdout:
+            if line.startswith('n'):
+                res.add(line[1:])
+        return res
+
+    for pid in os.listdir(PROC_PATH):
+        if not pid.isdigit():
+            continue
+        path_fd = os.path.join(PROC_PATH, pid, 'fd')
         try:
-            os.renames(file, file_dst)
+            fds = os.listdir(path_fd)
+        except OSError:     # permission denied or process ended
+            continue
+        for fd in fds:
+            try:
+                res.add(os.readlink(os.path.join(path_fd, fd)))
+            except OSError:
+                pass
+    return res
+
+def _get_mtimes(file):
+    res = {}
+    for entry in iter_entries(file):
+        try:
+            res[entry.file] = entry.stat().st_mtime
         except OSError:
-            logger.exception('exception')
-            return file
-    return file_dst
+            pass
+    return res
+
+def _has_open(file, open_files):
+    root = os.path.realpath(file)
+    for entry in iter_entries(root):
+        file_ = os.path.realpath(entry.file) if entry.is_symlink() else entry.file
+        if file_ in open_files:
+            return True
+    return False
+
+def get_open(files, check_mtime=True, mtime_delta=5):
+    '''Get the files which are open.
+    Directories are open if any file inside is open.
+
+    All the files are checked against a single open files snapshot
+    and a single modified time delay.
+
+    :param files: files or directories
+    :param check_mtime: check the files modified time
+    :return: set of open files
+    '''
+    files = [f for f in files if os.path.exists(f)]
+    if not files:
+        return set()
+
+    open_files = get_open_files()
+    res = set([f for f in files if _has_open(f, open_files)])
+
+    if check_mtime:
+        files = [f for f in files if f not in res]
+        if files:
+            data0 = dict([(f, _get_mtimes(f)) for f in files])
+            time.sleep(mtime_delta)
+            for file in files:
+                if _get_mtimes(file) != data0[file]:
+                    res.add(file)
+
+    return res
 
 def is_file_open(file, check_mtime=True, mtime_delta=5):
     '''Return True if the file is open.
@@ -252,21 +805,8 @@ def is_file_open(file, check_mtime=True, mtime_delta=5):
     :param file: file or directory
     :param check_mtime: check the file modified time
     '''
-    if not os.path.exists(file):
-        return False
-    for file_ in iter_files(file):
-        if popen(['lsof', file_])[-1] == 0:
-            return True
-
-    if check_mtime:
-        def get_stat():
-            return dict([(f, os.stat(f).st_mtime) for f in iter_files(file)])
-        data0 = get_stat()
-        time.sleep(mtime_delta)
-        data1 = get_stat()
-        return data0 != data1
-
-    return False
+    return file in get_open([file], check_mtime=check_mtime,
+            mtime_delta=mtime_delta)
 
 def is_duplicate(src, dst):
     '''Check if source is identical to destination.
@@ -354,24 +894,348 @@ def is_html(data):
         return True
 
 
+class FileInfoIndex(object):
+    '''Sqlite backed index of files info, invalidated
+    when the file size, modified time or inode change.
+
+    :param file: sqlite file
+    '''
+    def __init__(self, file):
+        self.cache = PersistentCache(file, table='file_info')
+
+    def _get_key(self, entry):
+        return repr(entry.file)
+
+    def _get_signature(self, entry):
+        try:
+            stat = entry.stat()
+        except OSError:
+            return
+        return (INFO_INDEX_VERSION, stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def get(self, file):
+        '''Get the info of a file if it did not change.
+
+        :param file: file or Entry object
+        '''
+        return self.get_many([file]).get(get_entry(file).file)
+
+    def get_many(self, files):
+        '''Get the info of the files which did not change.
+
+        :param files: files or Entry objects
+        :return: dict of file: info
+        '''
+        entries = [get_entry(f) for f in files]
+        data = self.cache.get_many([self._get_key(e) for e in entries])
+        res = {}
+        for entry in entries:
+            val = data.get(self._get_key(entry))
+            if val and val[0] == self._get_signature(entry):
+                res[entry.file] = val[1]
+        return res
+
+    def set(self, file, info):
+        self.set_many([(file, info)])
+
+    def set_many(self, items):
+        '''Store the info of files in a single transaction.
+
+        :param items: iterable of (file or Entry object, info)
+        '''
+        data = []
+        for file, info in items:
+            entry = get_entry(file)
+            signature = self._get_signature(entry)
+            if signature:
+                data.append((self._get_key(entry), (signature, info)))
+        self.cache.set_many(data)
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.cache.close()
+
+
+#
+# Archives
+#
+
+class ArchiveError(Exception): pass
+class BadArchiveError(ArchiveError): pass
+class UnsupportedArchiveError(ArchiveError): pass
+
+
+def _get_member_file(path, name):
+    '''Get the destination of an archive member,
+    or None if it is outside of the path.
+    '''
+    file = os.path.normpath(os.path.join(path, name))
+    if file.startswith(os.path.join(path, '')):
+        return file
+
+def _write_member(fd, file, mtime=None):
+    '''Copy an archive member file object to disk.
+
+    :raise BadArchiveError: if the member data is corrupt
+    '''
+    path = os.path.dirname(file)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    try:
+        with open(file, 'wb') as fd_dst:
+            while True:
+                try:
+                    data = fd.read(UNPACK_BUFFER_SIZE)
+                except UNPACK_READ_ERRORS as e:
+                    raise BadArchiveError('%s: %s' % (os.path.basename(file), str(e)))
+                if not data:
+                    break
+                fd_dst.write(data)
+    except Exception:
+        if os.path.exists(file):
+            os.remove(file)
+        raise
+    if mtime:
+        os.utime(file, (mtime, mtime))
+
+def unpack_zip(file, path, progress=None):
+    '''Extract a zip archive in process.
+
+    Corrupt members are skipped, the other members are still extracted.
+
+    :param progress: callable receiving the extracted file, the count
+        of extracted members and the members count after each member
+    :raise BadArchiveError: if the archive is unreadable
+    :raise UnsupportedArchiveError: if a member compression is not
+        supported by zipfile (e.g.: deflate64, bzip2, lzma)
+    :raise ArchiveError: if the archive is password protected
+        or if members are corrupt
+    '''
+    try:
+        zf = zipfile.ZipFile(file)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        raise BadArchiveError(str(e))
+
+    with closing(zf):
+        members = zf.infolist()
+        failed = []
+        for member in members:
+            if member.compress_type not in ZIP_COMPRESS_TYPES:
+                raise UnsupportedArchiveError('%s: unsupported compression type %s' % (
+                        member.filename, member.compress_type))
+        for i, member in enumerate(members):
+            file_dst = _get_member_file(path, member.filename)
+            if not file_dst:
+                logger.error('skipped %s member %s: outside of %s', file, member.filename, path)
+                continue
+            if member.filename.endswith('/'):
+                if not os.path.exists(file_dst):
+                    os.makedirs(file_dst)
+            elif member.flag_bits & 0x1:
+                raise ArchiveError('password protected')
+            else:
+                try:
+                    try:
+                        fd = zf.open(member)
+                    except UNPACK_READ_ERRORS as e:
+                        raise BadArchiveError('%s: %s' % (member.filename, str(e)))
+                    with closing(fd):
+                        _write_member(fd, file_dst,
+                                mtime=time.mktime(member.date_time + (0, 0, -1)))
+                except BadArchiveError as e:
+                    logger.error('skipped %s member: %s', file, str(e))
+                    failed.append(member.filename)
+                    continue
+            if progress:
+                progress(file_dst, i + 1, len(members))
+
+        if failed:
+            raise ArchiveError('corrupt members: %s' % ', '.join(failed))
+
+def unpack_tar(file, path, progress=None):
+    '''Extract a tar archive (optionally gzip or bzip2 compressed)
+    in process, reading it in a single pass.
+
+    Only files and directories are extracted.
+
+    :param progress: callable receiving the extracted file, the count
+        of extracted members and None (the members count is unknown)
+    :raise BadArchiveError: if the archive is corrupt
+    '''
+    try:
+        tf = tarfile.open(file, 'r|*')
+    except UNPACK_READ_ERRORS as e:
+        raise BadArchiveError(str(e))
+
+    with closing(tf):
+        members = iter(tf)
+        count = 0
+        while True:
+            try:
+                member = next(members)
+            except StopIteration:
+                break
+            except UNPACK_READ_ERRORS as e:
+                raise BadArchiveError(str(e))
+
+            file_dst = _get_member_file(path, member.name)
+            if not file_dst:
+                logger.error('skipped %s member %s: outside of %s', file, member.name, path)
+                continue
+            if member.isdir():
+                if not os.path.exists(file_dst):
+                    os.makedirs(file_dst)
+            elif member.isfile():
+                _write_member(tf.extractfile(member), file_dst, mtime=member.mtime)
+            else:
+                logger.debug('skipped %s member %s: not a file', file, member.name)
+                continue
+            count += 1
+            if progress:
+                progress(file_dst, count, None)
+
+def _get_extracted_files(file, path, ext, stdout):
+    '''Get the files extracted in the path by an archive command.
+
+    The files are read from the command output and from the archive
+    members list (see ARCHIVE_LIST_DEF), since the output of some
+    commands does not list the files (e.g.: recent 7za versions)
+    and the members list of some archives is not available
+    (e.g.: split zip archives).
+    '''
+    names = []
+    re_file = RE_EXTRACTED_FILE.get(ext)
+    if re_file:
+        for line in stdout or []:
+            res = re_file.search(RE_EXTRACT_PROGRESS.sub('', line))
+            if res:
+                names.append(res.group(1))
+    if ext in ARCHIVE_LIST_DEF:
+        stdout, stderr, returncode = popen(ARCHIVE_LIST_DEF[ext] + [file], cwd=path)
+        if returncode == 0:
+            for line in stdout:
+                res = RE_ARCHIVE_MEMBER[ext].search(line)
+                if res:
+                    names.append(res.group(1))
+
+    extracted = set()
+    for name in names:
+        file_ = _get_member_file(path, name)
+        if file_ and file_ != file and os.path.isfile(file_):
+            extracted.add(file_)
+    return sorted(extracted)
+
+def _get_unpack_func(file, ext):
+    if ext == '.zip':
+        # Split zip archives need the command
+        if not os.path.exists(os.path.splitext(file)[0] + '.z01'):
+            return unpack_zip
+    elif ext in TAR_EXTS or ext in ('.gz', '.bz2'):
+        return unpack_tar
+
+
 #
 # File types
 #
 
 class File(object):
+    '''File or directory.
 
-    def __init__(self, file, real_file=None):
-        self.file = file
-        self.type = get_type(file)
-        self.path, self.filename, self.ext = fsplit(file)
-        self.dir = os.path.basename(self.path)
+    The type, path, filename and extension (and their real_* equivalents)
+    are computed on first access.
 
-        if real_file:
-            self.real_file = real_file
-            self.real_type = get_type(real_file)
-            self.real_path, self.real_filename, self.real_ext = fsplit(real_file)
-            self.real_dir = os.path.basename(self.real_path)
-            self.type = self.real_type
+    :param file: file or Entry object
+    :param real_file: real file (e.g.: the finished file of a download)
+    '''
+    __slots__ = ['entry', 'real_entry', '_type', '_fsplit', '_real_type', '_real_fsplit']
+
+    def __init__(self, file, real_file=None):
+        self.entry = get_entry(file)
+        self.real_entry = get_entry(real_file) if real_file else None
+        self._type = _unset
+        self._fsplit = None
+        self._real_type = _unset
+        self._real_fsplit = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.file)
+
+    def __reduce__(self):
+        real_file = self.real_entry.file if self.real_entry is not None else None
+        return self.__class__, (self.file, real_file)
+
+    @property
+    def file(self):
+        return self.entry.file
+
+    @property
+    def type(self):
+        if self.real_entry is not None:
+            return self.real_type
+        if self._type is _unset:
+            self._type = get_type(self.entry)
+        return self._type
+
+    def _get_fsplit(self):
+        if self._fsplit is None:
+            self._fsplit = fsplit(self.entry)
+        return self._fsplit
+
+    @property
+    def path(self):
+        return self._get_fsplit()[0]
+
+    @property
+    def filename(self):
+        return self._get_fsplit()[1]
+
+    @property
+    def ext(self):
+        return self._get_fsplit()[2]
+
+    @property
+    def dir(self):
+        return os.path.basename(self.path)
+
+    def _get_real_entry(self):
+        # Missing real_* attributes when there is no real file
+        # (e.g.: getattr(file, 'real_ext', file.ext))
+        if self.real_entry is None:
+            raise AttributeError('no real file for %s' % self.file)
+        return self.real_entry
+
+    @property
+    def real_file(self):
+        return self._get_real_entry().file
+
+    @property
+    def real_type(self):
+        if self._real_type is _unset:
+            self._real_type = get_type(self._get_real_entry())
+        return self._real_type
+
+    def _get_real_fsplit(self):
+        if self._real_fsplit is None:
+            self._real_fsplit = fsplit(self._get_real_entry())
+        return self._real_fsplit
+
+    @property
+    def real_path(self):
+        return self._get_real_fsplit()[0]
+
+    @property
+    def real_filename(self):
+        return self._get_real_fsplit()[1]
+
+    @property
+    def real_ext(self):
+        return self._get_real_fsplit()[2]
+
+    @property
+    def real_dir(self):
+        return os.path.basename(self.real_path)
 
     def get_file_info(self):
         '''Get the file info.
@@ -386,7 +1250,35 @@ class File(object):
 
 class Media(File):
 
+    __slots__ = []
     TYPES = ['video', 'audio']
+    info_index = None
+
+    @classmethod
+    def set_info_index(cls, file):
+        '''Store the media files info in a sqlite file, or disable it if file is None.
+        '''
+        if Media.info_index:
+            Media.info_index.close()
+        Media.info_index = FileInfoIndex(file) if file else None
+
+    def get_file_info(self):
+        '''Get the file info, from the info index if the file did not change.
+        '''
+        index = Media.info_index
+        if index is None:
+            return self._get_file_info()
+        info = index.get(self.entry)
+        if info is None:
+            # Do not store the info of failed mediainfo runs
+            media_info = get_info(self.file)
+            info = self._get_file_info(media_info or {})
+            if media_info is not None:
+                index.set(self.entry, info)
+        return info
+
+    def _get_file_info(self, media_info=None):
+        return {}
 
     def _has_unrelated(self, name, path):
         '''Check unrelated media in the given directory.
@@ -414,18 +1306,24 @@ class Media(File):
 
 class Video(Media):
 
-    def get_file_info(self):
+    __slots__ = []
+
+    def _get_file_info(self, media_info=None):
         '''Get the file info.
+
+        :param media_info: mediainfo info of the file if already extracted
         '''
-        info = get_info(self.file)
+        info = get_info(self.file) if media_info is None else media_info
         if not info:
             logger.debug('failed to get media info from %s', self.file)
+            info = {}
 
         # Get title info using parent directory name and its parent's name
-        title = Title(self.filename, [self.dir, os.path.basename(os.path.dirname(self.path))])
+        title = Title.parse(self.filename, (self.dir, os.path.basename(os.path.dirname(self.path))))
         for key in ('full_name', 'display_name', 'name',
-                'season', 'episode', 'date', 'rip', 'langs'):
+                'season', 'episode', 'date', 'rip'):
             info[key] = getattr(title, key)
+        info['langs'] = list(title.langs)
 
         if info['episode'] and (RE_TVSHOW_CHECK.search(self.filename) or check_size(self.file, size_max=SIZE_TVSHOW_MAX)):
             info['subtype'] = 'tv'
@@ -474,10 +1372,14 @@ class Video(Media):
 
 class Audio(Media):
 
-    def get_file_info(self):
+    __slots__ = []
+
+    def _get_file_info(self, media_info=None):
         '''Get the file info.
+
+        :param media_info: mediainfo info of the file if already extracted
         '''
-        info = get_info(self.file)
+        info = (get_info(self.file) if media_info is None else media_info) or {}
         if info:
             info['full_name'] = '%s%s%s' % (info['artist'], ' ' if info['artist'] and info['album'] else '', info['album'])
             info['display_name'] = '%s%s%s' % (info['artist'], ' - ' if info['artist'] and info['album'] else '', info['album'])
@@ -491,6 +1393,8 @@ class Audio(Media):
 
 class Subtitles(File):
 
+    __slots__ = []
+
     def get_file_info(self):
         '''Get the file info.
         '''
@@ -504,7 +1408,7 @@ class Subtitles(File):
         except Exception:
             pass
 
-        title = Title(self.filename, self.dir)
+        title = Title.parse(self.filename, self.dir)
         for key in ('full_name', 'display_name', 'name',
                 'season', 'episode', 'date'):
             info[key] = getattr(title, key)
@@ -521,6 +1425,8 @@ class Subtitles(File):
 
 class Archive(File):
 
+    __slots__ = []
+
     def get_file_info(self):
         '''Get the file info.
         '''
@@ -569,7 +1475,7 @@ class Archive(File):
         pattern = re.sub(r'part\d+', r'part\\d+', re.escape(filename_))
 
         # Get files with an archive extension
-        pattern_ext = r'(%s)' % '|'.join([re.escape(k) for k in ARCHIVE_DEF])
+        pattern_ext = r'(%s)' % '|'.join([re.escape(k) for k in ARCHIVE_EXTS])
         re_files = re.compile(r'/%s%s(\..*)?$' % (pattern, pattern_ext), re.I)
         files_ = sorted([f.file for f in files(self.path,
                 re_file=re_files, recursive=False)])
@@ -586,21 +1492,48 @@ class Archive(File):
 
         return files_
 
-    def unpack(self, remove_src=True, remove_failed=True):
+    def unpack(self, remove_src=True, remove_failed=True, progress=None):
         '''Unpack the archive in its directory.
 
+        zip and tar archives are extracted in process,
+        the other formats with their command (see ARCHIVE_DEF).
+
+        :param remove_failed: remove the source of bad archives
+        :param progress: callable receiving the extracted file, the count
+            of extracted members and the members count (None if unknown)
+            after each member; with a command, it receives the extracted
+            files after the extraction (see _get_extracted_files())
         :return: processed files list (including multipart files)
         '''
         ext = self.ext.lower()
-        stdout, stderr, returncode = popen(ARCHIVE_DEF[ext] + [self.file], cwd=self.path)
-        if returncode != 0:
-            if remove_failed and ext in RE_EXTRACT_ERRORS:
-                if [l for l in stderr if RE_EXTRACT_ERRORS[ext].search(l)]:
+        unpack_func = _get_unpack_func(self.file, ext)
+        if unpack_func:
+            try:
+                unpack_func(self.file, self.path, progress=progress)
+            except UnsupportedArchiveError as e:
+                logger.debug('failed to extract %s in process: %s', self.file, str(e))
+                unpack_func = None
+            except BadArchiveError as e:
+                logger.info('failed to extract %s: bad archive (%s)', self.file, str(e))
+                if remove_failed:
                     remove_src = True
-                    logger.info('failed to extract %s: bad archive', self.file)
-                else:
-                    remove_src = False
-                    logger.error('failed to extract %s: %s, %s', self.file, stdout, stderr)
+            except Exception as e:
+                logger.error('failed to extract %s: %s', self.file, str(e))
+                remove_src = False
+        if not unpack_func:
+            stdout, stderr, returncode = popen(ARCHIVE_DEF[ext] + [self.file], cwd=self.path)
+            if progress:
+                extracted = _get_extracted_files(self.file, self.path, ext, stdout)
+                for i, file in enumerate(extracted):
+                    progress(file, i + 1, len(extracted))
+            if returncode != 0:
+                if remove_failed and ext in RE_EXTRACT_ERRORS:
+                    if [l for l in stderr if RE_EXTRACT_ERRORS[ext].search(l)]:
+                        remove_src = True
+                        logger.info('failed to extract %s: bad archive', self.file)
+                    else:
+                        remove_src = False
+                        logger.error('failed to extract %s: %s, %s', self.file, stdout, stderr)
 
         processed = self.get_multipart_files()
 
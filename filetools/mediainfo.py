@@ -1,48 +1,160 @@
-import re
+import subprocess
+import threading
+import tempfile
+from multiprocessing.pool import ThreadPool
 import logging
 
-from systools.system import popen
-
 from filetools.title import clean
 
 
+MEDIAINFO_BATCH_SIZE = 50    # files per mediainfo process
+MEDIAINFO_WORKERS = 4
+MEDIAINFO_TIMEOUT = 60     # seconds
+MEDIAINFO_FIELDS = {    # fields kept by category, '*' for the other categories
+    'general': set(['complete name', 'duration', 'overall bit rate',
+            'performer', 'album', 'recorded date',
+            'track name', 'track name/position']),
+    '*': set(['bit rate', 'codec', 'codec id']),
+    }
+
 logger = logging.getLogger(__name__)
 
 
 class MediainfoError(Exception): pass
 
 
-def parse(file):
-    res = {}
+class Command(object):
+    '''Command iterating over its stdout lines as they are written.
 
-    cmd = ['mediainfo', '-language=raw', '-f', file]
-    stdout, stderr, return_code = popen(cmd)
-    if return_code is None:
-        raise MediainfoError('failed to run command "%s"' % ' '.join(cmd))
-    elif return_code != 0:
-        logger.error('failed to parse file %s: %s, %s', file, stdout, stderr)
-        return res
-
-    cat = None
-    for line in stdout:
-        fields = re.split(r'\s*:\s*', line.decode('utf-8').lower())
-
-        if len(fields) == 1:
-            cat = fields[0]
-            if cat:
-                res[cat] = {}
-        elif cat and len(fields) == 2:
-            if not res[cat].get(fields[0]):
-                res[cat][fields[0]] = fields[1]
+    stderr goes to a temporary file so it cannot block the process.
 
-    return res
+    :param cmd: command list
+    :param timeout: kill the process after this delay (seconds)
+    '''
+    def __init__(self, cmd, timeout=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.returncode = None
+        self.stderr = []
+        self.timed_out = False
+
+    def __str__(self):
+        return ' '.join(self.cmd)
+
+    def _kill(self, proc):
+        self.timed_out = True
+        proc.kill()
+
+    def __iter__(self):
+        stderr = tempfile.TemporaryFile()
+        try:
+            proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=stderr)
+        except OSError as e:
+            stderr.close()
+            raise MediainfoError('failed to run command "%s": %s' % (self, str(e)))
+
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self._kill, [proc])
+            timer.start()
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                yield line
+            self.returncode = proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            stderr.seek(0)
+            self.stderr = stderr.read().splitlines()
+            stderr.close()
+
+        if self.timed_out:
+            raise MediainfoError('command "%s" timed out' % self)
+
+
+def _parse_lines(lines, fields=MEDIAINFO_FIELDS):
+    '''Parse mediainfo output lines.
+
+    Lines are split on their first colon and only
+    the kept values are decoded.
+
+    :param fields: dict of fields to keep by category (see MEDIAINFO_FIELDS),
+        None to keep all the fields
+    :return: iterator of results, one per file
+    '''
+    res = None
+    data = None
+    keys = None
+    for line in lines:
+        key, sep, val = line.partition(':')
+
+        if not sep:
+            cat = key.strip().lower().decode('utf-8')
+            if not cat:
+                data = None
+                continue
+            # Each file output starts with its general category
+            if res is None or cat == 'general':
+                if res is not None:
+                    yield res
+                res = {}
+            res[cat] = data = {}
+            if fields is not None:
+                keys = fields.get(cat, fields.get('*', ()))
+
+        elif data is not None:
+            key = key.strip().lower()
+            if keys is not None and key not in keys:
+                continue
+            key = key.decode('utf-8')
+            if not data.get(key):
+                data[key] = val.strip().decode('utf-8').lower()
+
+    if res is not None:
+        yield res
+
+def parse(file, timeout=None, fields=MEDIAINFO_FIELDS):
+    '''Parse the mediainfo output of a file.
+
+    :param timeout: kill mediainfo after this delay (seconds)
+    :param fields: fields to keep (see _parse_lines())
+    :return: dict, None if mediainfo failed
+    '''
+    cmd = Command(['mediainfo', '-language=raw', '-f', file], timeout=timeout)
+    res = list(_parse_lines(cmd, fields))
+    if cmd.returncode != 0:
+        logger.error('failed to parse file %s: %s', file, cmd.stderr)
+        return None
+    return res[0] if res else {}
 
-def get_info(file):
-    '''Get main info by category.
+def parse_many(files, fields=MEDIAINFO_FIELDS):
+    '''Parse files with a single mediainfo process.
+
+    :return: list of parse results in the files order
     '''
+    cmd = Command(['mediainfo', '-language=raw', '-f'] + list(files))
+    res = list(_parse_lines(cmd, fields))
+    if cmd.returncode != 0:
+        raise MediainfoError('failed to run command "%s": %s' % (cmd, cmd.stderr))
+    if len(res) != len(files):
+        raise MediainfoError('got %s results for %s files' % (len(res), len(files)))
+
+    for file, data in zip(files, res):
+        name = data.get('general', {}).get('complete name')
+        if not isinstance(file, unicode):
+            file = file.decode('utf-8')
+        if name and name != file.lower():
+            raise MediainfoError('got results of %s for %s' % (name, file))
+    return res
+
+def _get_info(data):
     res = {}
 
-    for cat, info in parse(file).items():
+    for cat, info in data.items():
 
         if cat == 'general':
             try:
@@ -79,3 +191,57 @@ def get_info(file):
             res['%s_codec_id' % cat] = info.get('codec id')
 
     return res
+
+def get_info(file):
+    '''Get main info by category.
+
+    :return: dict, None if mediainfo failed
+    '''
+    data = parse(file)
+    if data is not None:
+        return _get_info(data)
+
+def get_info_many(files, batch_size=MEDIAINFO_BATCH_SIZE):
+    '''Get main info by category of many files,
+    running mediainfo on batches of files.
+
+    A failed batch falls back to one mediainfo process per file.
+
+    :return: dict of file: info, info is None if mediainfo failed
+    '''
+    files = list(files)
+    res = {}
+    for i in range(0, len(files), batch_size):
+        batch = files[i:i + batch_size]
+        try:
+            for file, data in zip(batch, parse_many(batch)):
+                res[file] = _get_info(data)
+        except MediainfoError as e:
+            logger.debug('failed to parse files batch: %s', str(e))
+            for file in batch:
+                res[file] = get_info(file)
+    return res
+
+def _get_info_safe(args):
+    file, timeout = args
+    try:
+        data = parse(file, timeout=timeout)
+    except MediainfoError as e:
+        logger.error('failed to get %s info: %s', file, str(e))
+        return file, None
+    return file, _get_info(data) if data else None
+
+def get_info_concurrent(files, max_workers=MEDIAINFO_WORKERS, timeout=MEDIAINFO_TIMEOUT):
+    '''Get main info by category of many files,
+    running at most max_workers mediainfo processes at once.
+
+    :param timeout: timeout of each mediainfo process (seconds)
+    :return: iterator of (file, info) in completion order,
+        info is None if mediainfo failed or timed out
+    '''
+    pool = ThreadPool(max_workers)
+    try:
+        for res in pool.imap_unordered(_get_info_safe, [(f, timeout) for f in files]):
+            yield res
+    finally:
+        pool.terminate()
@@ -1,12 +1,23 @@
+import os
+import sys
 import re
+import time
+import atexit
 from datetime import datetime
 from urlparse import urlparse
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+from itertools import islice, chain
+from multiprocessing import Pool, cpu_count
 import logging
 
 from lxml import html
 
 import trans
 
+from filetools.utils import LRUCache, PersistentCache
+
 
 RE_EPISODE_LIST = [
     re.compile(r'\b(s?(\d{1,2})[ex](\d{2}))\b', re.I),
@@ -38,13 +49,249 @@ PATTERNS_LANGS = {
     }
 LANG_DEFAULT = 'en'     # default language when none found
 SEARCH_MODE_MIN_CHARS = 8
+PARSE_CACHE_SIZE = 4096
+PARSE_CACHE_VERSION = 1     # increment when parsing results change
+PARSE_MANY_MIN_ITEMS = 1000     # parse in process below this number of items
+PARSE_MANY_CHUNKSIZE = 200
+ENGINES = ('regex', 'tokens')
+ENGINE_DEFAULT = 'regex'
+TOKEN_WORD = 'word'
+TOKEN_YEAR = 'year'
+TOKEN_EPISODE = 'episode'
+TOKEN_RIP = 'rip'
+TOKEN_LANG = 'lang'
+TOKEN_BRACKET = 'bracket'
+TOKEN_WORDS_CACHE_SIZE = 10000
+SEARCH_CACHE_SIZE = 1024
+CLEAN_CACHE_SIZE = 10000
+PROFILE_SLOWEST_COUNT = 5
+PROFILE_ENV = 'FILETOOLS_PROFILE'
+
+
+def _get_rip_patterns():
+    plang = '|'.join(PATTERNS_LANGS.values())
+    p1 = r'((%s)[\W_]+)*([\W_]*%s[\W_]*)' % (plang, PATTERN_RIP_PRE)
+    p2 = r'((%s)[\W_]+)*([\W_]*%s|%s[\W_]*)' % (plang, PATTERN_RIP_MOVIES, PATTERN_RIP_TV)
+    p3 = r'((%s)[\W_]+)*([\W_]*%s[\W_]*)' % (plang, PATTERN_RIP_FORMAT)
+    p4 = r'((%s)[\W_]+)*([\W_]*%s[\W_]*)' % (plang, PATTERN_RIP_EXTRA)
+    return [r'%s[\W_]*%s' % (p4, p4), r'%s[\W_]*%s' % (p4, p2), p1, p2, p3]
+
+def _get_non_capturing(pattern):
+    return re.sub(r'(?<!\\)\((?!\?)', '(?:', pattern)
+
+def _get_safe_separators_pattern(count=2, begin=False):
+    r'''Get a pattern matching the same as adjacent words separators
+    ([\W_s]*E*[\W_]*(J[\W_]+)*, E being an extra and J a junk word)
+    in a single way, so their repetitions cannot backtrack catastrophically.
+
+    Each separator is matched as phases of separator chars (W), extras (E)
+    and junk words tokens (T), every char being consumed by the earliest
+    phase able to: a closed bracket is matched as chars only if the current
+    phase can pass its closer, else as an extra or the match ends inside it.
+
+    :param count: number of separators (1 or 2)
+    :param begin: match a title beginning ([\W_]*E*[\W_]*(J[\W_]+)*)
+    '''
+    p_junk = '(?:%s)' % '|'.join(LIST_JUNK_SEARCH)
+    p_junk_word = '(?:%s)' % '|'.join([w for w in LIST_JUNK_SEARCH if w != 's'])
+    p_open = r'[\(\[]'
+    p_close = r'[\)\]]'
+    p_extra = r'[\(\[][^\)\]]*[\)\]]'
+    p_closed = r'[^\)\]]*[\)\]]'
+    p_unclosed = r'[^\)\]]*$'
+    p_char = r'(?:[^\w\)\]]|_)'     # inside brackets
+    p_char_s = r'(?:[^\w\)\]]|[_s])'
+    if begin:
+        p_char_w, p_junk_w, p_s = p_char, p_junk, ''
+    else:
+        p_char_w, p_junk_w, p_s = p_char_s, p_junk_word, '|s'
+    p_pass_w = r'%s*%s' % (p_char_w, p_close)
+    p_pass_t = r'(?:%s|%s(?=[\W_]))*%s' % (p_char, p_junk, p_close)
+    p_pass_tw = r'(?:%s|%s(?=[\W_]))*%s*%s' % (p_char, p_junk, p_char_s, p_close)
+
+    def get_char(p_pass):
+        return r'(?:[^\w\(\[]|_|%s(?=%s|%s))' % (p_open, p_unclosed, p_pass)
+
+    def get_bracket(p_pass, p_content):
+        p_guard = r'(?!%s)' % p_pass if p_pass else ''
+        return r'%s(?=%s)%s%s' % (p_open, p_closed, p_guard, p_content)
+
+    def get_content(kind, i, junk=False):
+        # brackets opened after a junk word are not extras: they can end
+        # with a nested extra or be left once past the current separator
+        p_t = r'(?:%s?%s)*' % (p_junk, p_char)
+        if kind == 'W':
+            return r'%s*(?:%s%s%s)?' % (p_char_w, p_junk_w, p_char, get_content('T', i))
+        if i == count:
+            return p_t
+        p_w = r's(?!%s)%s*' % (p_char, p_char_s)
+        if not junk:
+            return r'%s(?:%s(?:%s%s%s)?|s)?' % (p_t, p_w, p_junk_word, p_char, get_content('T', i + 1))
+        p_next = r'(?=%s[\W_])(?:%s?%s)*(?:%s?%s%s)?' % (p_junk_word, p_junk, p_char,
+                p_junk, p_close, get_phase('T', i + 1))
+        return r'%s(?:%s%s|(?:%s|s)?(?:%s%s)?)' % (p_t, p_w, p_next, p_w,
+                p_extra, get_phase('E', i + 1))
+
+    def get_phase(kind, i):
+        p_pass = p_pass_tw if i < count else p_pass_t
+        p_char_t = get_char(p_pass)
+        nexts = []
+        if kind == 'W':
+            p_loop = r'(?:%s%s)*' % (get_char(p_pass_w), p_s)
+            nexts.append(r'(?!%s%s)%s%s' % (p_open, p_pass_w, p_extra, get_phase('E', i)))
+            nexts.append(r'%s%s%s' % (p_junk_w, p_char_t, get_phase('T', i)))
+            nexts.append(get_bracket(p_pass_w, get_content('W', i)))
+            nexts.append(p_junk_w + get_bracket(p_pass, get_content('T', i, junk=True)))
+        elif kind == 'E':
+            p_loop = r'(?:%s)*' % p_extra
+            nexts.append(r'(?!%s%s)%s?%s%s' % (p_open, p_closed, p_junk, p_char_t, get_phase('T', i)))
+            if i < count:
+                nexts.append(r's(?!%s)%s' % (p_char_t, get_phase('W', i + 1)))
+                nexts.append('s')
+            nexts.append(get_bracket(None, get_content('T', i)))
+            nexts.append(p_junk + get_bracket(p_pass, get_content('T', i, junk=True)))
+        else:
+            p_loop = r'(?:%s?%s)*' % (p_junk, p_char_t)
+            if i < count:
+                nexts.append(r's(?!%s)%s' % (p_char_t, get_phase('W', i + 1)))
+                nexts.append('s')
+                nexts.append(r'(?!%s%s)%s%s' % (p_open, p_pass, p_extra, get_phase('E', i + 1)))
+            nexts.append(r'%s?%s' % (p_junk, get_bracket(p_pass, get_content('T', i, junk=True))))
+        return r'%s(?:%s)?' % (p_loop, '|'.join(nexts))
+
+    return get_phase('W', 1)
+
+
+# Compiled patterns registry
+RE_EXTRA_TRAILING = re.compile(r'(.+?)(%s.*$)' % PATTERN_EXTRA, re.I)
+RE_EXTRA_AFTER = re.compile(r'(.+)%s' % PATTERN_EXTRA, re.I)
+RE_EXTRA_BEFORE = re.compile(r'%s(.+)' % PATTERN_EXTRA, re.I)
+RE_CONTROL_CHARS = re.compile(r'[\n\r\t]+')
+RE_NO_BREAK_SPACES = re.compile(r'(&(nbsp|#160|#xA0);)+')
+RE_SPECIAL_CHARS = re.compile(r'[<&]|[^\x20-\x7e]')    # markup, entities and non printable ascii chars
+RE_OPEN_BRACKET = re.compile(r'[\(\[\{<][^\)\]\}>]*$')
+RE_WORD_SEP = re.compile(r'[\W_]+')
+RE_RIP_TV = re.compile(PATTERN_RIP_TV, re.I)
+RE_RIP_MOVIES = re.compile(PATTERN_RIP_MOVIES, re.I)
+RE_RIP = re.compile(_get_non_capturing(r'[\W_](%s)([\W_].*$|$)' % '|'.join(_get_rip_patterns())), re.I)
+RE_LANGS = [(lang, re.compile(r'(^|[\W_])(%s)([\W_]|$)' % pattern, re.I))
+        for lang, pattern in PATTERNS_LANGS.items()]
+RE_TOKEN = re.compile(r"[^\W_]+('[^\W_]+)*")
+RE_TOKEN_BRACKET = re.compile(PATTERN_EXTRA)
+RE_TOKEN_RIP = re.compile(r'^(%s|%s)$' % (PATTERN_RIP_PRE, PATTERN_RIP_FORMAT), re.I)
+RE_TOKEN_RIP_SOURCE = re.compile(r'^(%s|%s)$' % (PATTERN_RIP_MOVIES, PATTERN_RIP_TV), re.I)
+RE_TOKEN_RIP_EXTRA = re.compile(r'^(%s)$' % PATTERN_RIP_EXTRA, re.I)
+RE_TOKEN_RIP_DISC = re.compile(r'^(cd|dvd)\d*$', re.I)
+RE_TOKEN_RIP_ABSORB = re.compile(r'^(\d*(cd|dvd)\d*|ac3|ws|blu[\W_]*ray)$', re.I)    # first alternatives of the rip patterns
+RE_TOKEN_LANGS = [(lang, re.compile(r'^(%s)$' % pattern, re.I))
+        for lang, pattern in PATTERNS_LANGS.items()]
+RE_TOKEN_SUBS = re.compile(r'^subs?(titles)?$', re.I)
+RE_TOKEN_EPISODE_LIST = [
+    re.compile(r'^()s?(\d{1,2})[ex](\d{2})$', re.I),
+    re.compile(r'^()(\d{1,2})(\d{2})$', re.I),
+    re.compile(r'^()part()(\d+)$', re.I),
+    re.compile(r'^(.*\D|)()(\d{1,2})$', re.I),
+    ]
+RIP_SOURCE_PAIRS = set([('blu', 'ray'), ('tv', 'rip'), ('bd', 'scr'), ('br', 'scr')])
 
 logger = logging.getLogger(__name__)
 
 
+class Profiler(object):
+    '''Collect the call count, cumulative time and slowest inputs
+    of the title parsing stages.
+
+    :param slowest_count: number of slowest inputs to keep per stage
+    '''
+    def __init__(self, slowest_count=PROFILE_SLOWEST_COUNT):
+        self.slowest_count = slowest_count
+        self.stats = {}
+
+    def record(self, name, val, duration):
+        stat = self.stats.setdefault(name,
+                {'count': 0, 'total': 0, 'max': 0, 'slowest': []})
+        stat['count'] += 1
+        stat['total'] += duration
+        stat['max'] = max(stat['max'], duration)
+
+        slowest = stat['slowest']
+        if len(slowest) < self.slowest_count or duration > slowest[-1][0]:
+            slowest.append((duration, val))
+            slowest.sort(key=lambda x: x[0], reverse=True)
+            del slowest[self.slowest_count:]
+
+    def get_report(self):
+        '''Get the stages stats sorted by cumulative time.
+        '''
+        lines = ['%-20s %10s %12s %12s %12s' % ('stage', 'calls', 'total (s)', 'avg (ms)', 'max (ms)')]
+        for name, stat in sorted(self.stats.items(), key=lambda x: x[1]['total'], reverse=True):
+            lines.append('%-20s %10d %12.4f %12.4f %12.4f' % (name, stat['count'], stat['total'],
+                    stat['total'] * 1000 / stat['count'], stat['max'] * 1000))
+            for duration, val in stat['slowest']:
+                lines.append('    %10.4f ms  %r' % (duration * 1000, val))
+        return '\n'.join(lines)
+
+    def dump(self, file=None):
+        '''Write the report to a file object (default: stderr).
+        '''
+        (file or sys.stderr).write(self.get_report() + '\n')
+
+    def clear(self):
+        self.stats.clear()
+
+
+_profiler = None
+
+def _profiled(name, arg=0):
+    '''Record the calls of a function in the active profiler.
+
+    :param name: stage name
+    :param arg: index of the positional argument recorded as input
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                val = args[arg] if len(args) > arg else None
+                profiler.record(name, val, time.time() - begin)
+        return wrapper
+    return decorator
+
+@contextmanager
+def profile(profiler=None):
+    '''Profile the title parsing stages within the context.
+
+    :param profiler: Profiler object (a new one is created by default)
+    :return: Profiler object
+    '''
+    global _profiler
+    previous = _profiler
+    _profiler = profiler or Profiler()
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
+
+if os.environ.get(PROFILE_ENV):
+    # Profile the whole process and dump the report at exit
+    _profiler = Profiler()
+    atexit.register(_profiler.dump)
+
+
 def _clean_special(val):
-    val = re.sub(r'[\n\r\t]+', '', val)
-    val = re.sub(r'(&(nbsp|#160|#xA0);)+', ' ', val)    # replace no-break spaces
+    val = RE_CONTROL_CHARS.sub('', val)
+    val = RE_NO_BREAK_SPACES.sub(' ', val)    # replace no-break spaces
+
+    # Printable ascii values without markup are left unchanged
+    # by the html parser and the transliteration
+    if not RE_SPECIAL_CHARS.search(val):
+        return str(val).strip()
 
     # Remove html markup
     try:
@@ -59,9 +306,20 @@ def _clean_special(val):
 
     return str(val).strip()
 
+_clean_cache = LRUCache(CLEAN_CACHE_SIZE)
+
+@_profiled('clean')
 def clean(val, level=0):
     if not val:
         return ''
+    key = (val, level)
+    res = _clean_cache.get(key)
+    if res is None:
+        res = _clean(val, level)
+        _clean_cache.set(key, res)
+    return res
+
+def _clean(val, level=0):
     val = _clean_special(val)
 
     if level >= 1:
@@ -69,21 +327,21 @@ def clean(val, level=0):
 
         # Remove brackets with text inside and everything after if there's text before
         if level >= 4:
-            val = re.compile(r'(.+?)(%s.*$)' % PATTERN_EXTRA, re.I).sub(r'\1', val)
+            val = RE_EXTRA_TRAILING.sub(r'\1', val)
 
         # Remove brackets with text inside if there's text before or after
         if level >= 3:
-            val = re.compile(r'(.+)%s' % PATTERN_EXTRA, re.I).sub(r'\1 ', val)
-            val = re.compile(r'%s(.+)' % PATTERN_EXTRA, re.I).sub(r' \1', val)
+            val = RE_EXTRA_AFTER.sub(r'\1 ', val)
+            val = RE_EXTRA_BEFORE.sub(r' \1', val)
 
         # Remove rip info and everything after an open bracket
         if level >= 5:
             val = re.compile(r'%s' % re.escape(get_rip(val)), re.I).sub('', val)
-            val = re.compile(r'[\(\[\{<][^\)\]\}>]*$').sub('', val)
+            val = RE_OPEN_BRACKET.sub('', val)
 
         # Replace non-word characters
         val = val.replace("'", '')
-        val = ' '.join([w for w in re.split(r'[\W_]+', val) if w])
+        val = ' '.join([w for w in RE_WORD_SEP.split(val) if w])
 
         # Remove every word from the last date
         # TODO: check the date is not preceded by a '-' or other separator
@@ -99,13 +357,14 @@ def clean(val, level=0):
 
         # Get the most accurate name for media
         if level >= 9:
-            title = Title(val)
+            title = Title.parse(val)
             if title.episode:
                 val = '%s %s%s' % (title.name, '%s ' % title.season or '', title.episode)
             else:
                 val = title.name
     return val
 
+@_profiled('get_episode_info')
 def get_episode_info(title):
     '''Get episode info from a title.
     '''
@@ -138,34 +397,31 @@ def get_episode_info(title):
         return name, season, episode, episode_alt, extra
 
 def is_tv(title):
-    return re.compile(PATTERN_RIP_TV, re.I).search(title) is not None
+    return RE_RIP_TV.search(title) is not None
 
 def is_movies(title):
-    return re.compile(PATTERN_RIP_MOVIES, re.I).search(title) is not None
+    return RE_RIP_MOVIES.search(title) is not None
 
+@_profiled('get_rip')
 def get_rip(val):
     '''Get the rip info from a title.
     '''
-    plang = '|'.join(PATTERNS_LANGS.values())
-    p1 = r'((%s)[\W_]+)*([\W_]*%s[\W_]*)' % (plang, PATTERN_RIP_PRE)
-    p2 = r'((%s)[\W_]+)*([\W_]*%s|%s[\W_]*)' % (plang, PATTERN_RIP_MOVIES, PATTERN_RIP_TV)
-    p3 = r'((%s)[\W_]+)*([\W_]*%s[\W_]*)' % (plang, PATTERN_RIP_FORMAT)
-    p4 = r'((%s)[\W_]+)*([\W_]*%s[\W_]*)' % (plang, PATTERN_RIP_EXTRA)
-
-    rips = []
-    for pattern in [r'%s[\W_]*%s' % (p4, p4), r'%s[\W_]*%s' % (p4, p2), p1, p2, p3]:
-        res = re.compile(r'[\W_]%s([\W_].*$|$)' % pattern, re.I).search(val)
-        if res:
-            rips.append(res.group(0))
-
-    if rips:
-        return max(rips, key=len)
+    # Every rip pattern matches until the end of the value
+    # so the longest rip is the leftmost match of any of them
+    res = RE_RIP.search(val)
+    if res:
+        return res.group(0)
     return ''
 
+@_profiled('audio')
+def _search_audio(val):
+    return RE_AUDIO.search(val)
+
+@_profiled('get_langs')
 def get_langs(val):
     langs = []
-    for lang, pattern in PATTERNS_LANGS.items():
-        if re.compile(r'(^|[\W_])(%s)([\W_]|$)' % pattern, re.I).search(val):
+    for lang, re_lang in RE_LANGS:
+        if re_lang.search(val):
             langs.append(lang)
     if not langs:
         langs = [LANG_DEFAULT]
@@ -175,8 +431,9 @@ def is_year(val):
     if val.isdigit() and 1950 <= int(val) <= datetime.utcnow().year + 1:
         return True
 
+@_profiled('get_year')
 def get_year(val):
-    for word in re.split(r'[\W_]+', val):
+    for word in RE_WORD_SEP.split(val):
         if is_year(word):
             return int(word)
 
@@ -205,10 +462,228 @@ def get_size(val):
     return size
 
 def get_words(val):
-    return [w for w in re.split(r'[\W_]+', val.lower()) if w not in LIST_JUNK_SEARCH]
+    return [w for w in RE_WORD_SEP.split(val.lower()) if w not in LIST_JUNK_SEARCH]
+
+
+
+#
+# Tokens engine
+#
+
+_words_cache = {}
+
+
+def _get_word_info(word):
+    '''Get the (rip, rip_source, rip_extra, lang) info of a lowercase word.
+    '''
+    res = _words_cache.get(word)
+    if res is None:
+        if len(_words_cache) >= TOKEN_WORDS_CACHE_SIZE:
+            _words_cache.clear()
+        lang = None
+        for lang_, re_lang in RE_TOKEN_LANGS:
+            if re_lang.match(word):
+                lang = lang_
+                break
+        res = (RE_TOKEN_RIP.match(word) is not None,
+                RE_TOKEN_RIP_SOURCE.match(word) is not None,
+                RE_TOKEN_RIP_EXTRA.match(word) is not None,
+                lang)
+        _words_cache[word] = res
+    return res
+
+
+class Token(object):
+
+    __slots__ = ('value', 'start', 'end', 'bracket', 'trailing',
+            'rip', 'rip_source', 'rip_extra', 'lang', 'lang_suffix')
+
+    def __init__(self, value, start, end, bracket=None, trailing=False):
+        self.value = value
+        self.start = start
+        self.end = end
+        self.bracket = bracket      # start of the enclosing bracket group
+        self.trailing = trailing    # after an unclosed bracket
+        self.rip, self.rip_source, self.rip_extra, self.lang = _get_word_info(value)
+        self.lang_suffix = False    # completes the lang of the previous token
+
+    def __repr__(self):
+        return '<Token %s %r %s-%s>' % (self.type, self.value, self.start, self.end)
+
+    @property
+    def type(self):
+        if self.bracket is not None or self.trailing:
+            return TOKEN_BRACKET
+        elif is_year(self.value):
+            return TOKEN_YEAR
+        elif self.rip or self.rip_source or self.rip_extra:
+            return TOKEN_RIP
+        elif self.lang:
+            return TOKEN_LANG
+        for re_episode in RE_TOKEN_EPISODE_LIST[:3]:
+            if re_episode.match(self.value):
+                return TOKEN_EPISODE
+        return TOKEN_WORD
+
+
+@_profiled('tokenize')
+def tokenize(val):
+    '''Split a cleaned title into lowercase word tokens.
+    '''
+    brackets = [r.span() for r in RE_TOKEN_BRACKET.finditer(val)]
+    res = RE_OPEN_BRACKET.search(val)
+    open_bracket = res.start() if res else len(val)
+
+    tokens = []
+    for res in RE_TOKEN.finditer(val):
+        start, end = res.span()
+        bracket = None
+        for b_start, b_end in brackets:
+            if b_start < start and end <= b_end:
+                bracket = b_start
+                break
+        tokens.append(Token(res.group(0).lower().replace("'", ''),
+                start, end, bracket, start > open_bracket))
+
+    # Langs matched over 2 words ("eng subs", "sub french")
+    re_langs = dict(RE_TOKEN_LANGS)
+    for prev, token in zip(tokens, tokens[1:]):
+        sep = val[prev.end:token.start]
+        if prev.lang and not token.lang and RE_TOKEN_SUBS.match(token.value):
+            if re_langs[prev.lang].match(prev.value + sep + token.value):
+                token.lang = prev.lang
+                token.lang_suffix = True
+        if token.lang and not token.lang_suffix and prev.value in ('sub', 'subs'):
+            if re_langs[token.lang].match(prev.value + sep + token.value):
+                prev.lang = token.lang
+                prev.lang_suffix = False
+    return tokens
+
+def _is_rip_source(tokens, i):
+    return tokens[i].rip_source or (i + 1 < len(tokens)
+            and (tokens[i].value, tokens[i + 1].value) in RIP_SOURCE_PAIRS)
+
+def _get_rip_offset(tokens, i, start=0):
+    '''Get the rip offset if a rip begins with the token at index i.
+
+    Mirrors the patterns of get_rip: optional langs followed by a rip info,
+    or by rip extra info followed by more extra or source info.
+    '''
+    if tokens[i].start <= start or tokens[i].lang_suffix:
+        return
+    j = i
+    while j < len(tokens) and tokens[j].lang:
+        j += 1
+    if j == len(tokens):
+        return
+
+    token = tokens[j]
+    if token.rip or _is_rip_source(tokens, j):
+        absorb = RE_TOKEN_RIP_ABSORB.match(token.value) or (j + 1 < len(tokens)
+                and (token.value, tokens[j + 1].value) == ('blu', 'ray'))
+    elif token.value.isdigit() and j + 1 < len(tokens) \
+            and RE_TOKEN_RIP_DISC.match(tokens[j + 1].value):
+        absorb = True
+    elif token.rip_extra:
+        k = j + 1
+        while k < len(tokens) and tokens[k].lang:
+            k += 1
+        if k == len(tokens) or not (tokens[k].rip_extra or _is_rip_source(tokens, k)):
+            return
+        absorb = token.value == 'ws'
+    else:
+        return
+
+    # Only the first alternative of the rip patterns absorbs all the preceding separators
+    if absorb and j == i:
+        return tokens[i - 1].end if i > 0 and tokens[i - 1].end > start else start
+    return tokens[i].start - 1
+
+def _find_rip(tokens, start=0):
+    '''Get the index of the first rip token and the rip offset.
+    '''
+    for i in range(len(tokens)):
+        offset = _get_rip_offset(tokens, i, start)
+        if offset is not None:
+            return i, offset
+    return None, None
+
+def _get_full_name(val, tokens, last_date=False):
+    '''Get the equivalent of clean(val, 6) (or clean(val, 7)
+    if last_date is True) from the tokens of val.
+    '''
+    # Remove brackets with text inside and everything after if there's text before,
+    # then a leading bracket
+    start, end = 0, len(val)
+    res = RE_EXTRA_TRAILING.match(val)
+    if res:
+        end = res.end(1)
+    res = RE_EXTRA_BEFORE.match(val, 0, end)
+    if res:
+        start = res.start(1)
+    tokens = [t for t in tokens if t.start >= start and t.end <= end]
+
+    # Remove rip info and everything after an open bracket
+    # (the words after a leading bracket can begin a rip)
+    index, offset = _find_rip(tokens, start - 1 if start else 0)
+    if index is not None:
+        tokens, end = tokens[:index], offset
+    res = RE_OPEN_BRACKET.search(val, start, end)
+    if res:
+        tokens = [t for t in tokens if t.end <= res.start()]
+
+    words = [t.value for t in tokens]
+    if last_date:
+        date_indexes = [i for i, w in enumerate(words) if is_year(w)]
+        if date_indexes:
+            words = words[:date_indexes[-1]]
+    return ' '.join([w for w in words if not is_year(w)])
+
+def _get_year_tokens(tokens):
+    for token in tokens:
+        if is_year(token.value):
+            return int(token.value)
+
+def _get_episode_tokens(val, tokens):
+    '''Get the episode info with the same precedence as RE_EPISODE_LIST.
+
+    :return: tuple (sep, season, episode)
+    '''
+    for i_re, re_episode in enumerate(RE_TOKEN_EPISODE_LIST):
+        for i, token in enumerate(tokens):
+            res = re_episode.match(token.value)
+            if not res:
+                # Handle "part 2"
+                if i_re == 2 and token.value == 'part' and i + 1 < len(tokens) \
+                        and tokens[i + 1].value.isdigit():
+                    return val[token.start:tokens[i + 1].end], '', tokens[i + 1].value
+                continue
+
+            prefix, season, episode = res.groups()
+            if i_re == 3 and not prefix and token.start == 0:
+                continue
+            sep = val[token.start + len(prefix):token.end]
+            if is_year(sep):
+                return
+            return sep, season.lstrip('0'), episode
+
+
+class TitleInfo(namedtuple('TitleInfo', ['title', 'full_name', 'name',
+        'display_name', 'rip', 'date', 'langs', 'season', 'episode',
+        'episode_alt', 'artist', 'album', 'track_number', 'track_title'])):
+    '''Immutable title parsing result.
+    '''
+    __slots__ = ()
 
 
 class Title(object):
+    '''Title parser.
+
+    :param alt: alternate titles (e.g.: parent directories names)
+    :param engine: parsing engine, possible values:
+        - regex: layered regex substitutions
+        - tokens: single tokenization of the title
+    '''
 
     DEFAULTS = {
         'full_name': '',
@@ -225,9 +700,68 @@ class Title(object):
         'track_number': '',
         'track_title': '',
         }
-
-    def __init__(self, val, alt=None):
+    cache = LRUCache(PARSE_CACHE_SIZE)
+    persistent_cache = None
+    search_cache = LRUCache(SEARCH_CACHE_SIZE)
+
+    @_profiled('title', arg=1)
+    def __init__(self, val, alt=None, engine=ENGINE_DEFAULT):
+        if engine not in ENGINES:
+            raise ValueError('unknown engine "%s"' % engine)
         self.title = val
+        self.engine = engine
+        if engine == 'tokens':
+            self._parse_tokens(val)
+        else:
+            self._parse_regex(val)
+
+        # Set and clean attributes
+        for a, v in self.DEFAULTS.items():
+            if getattr(self, a, None) is None:
+                setattr(self, a, v)
+
+        # Check alternate items and update info
+        if alt:
+            self._update_alt(alt)
+
+        # Remove default language if others exist
+        if len(self.langs) > 1 and LANG_DEFAULT in self.langs:
+            self.langs.remove(LANG_DEFAULT)
+
+        # Handle anime episode
+        if self.episode_alt and not is_tv(self.rip):
+            self.season = ''
+            self.episode = self.episode_alt
+
+        # Get display name
+        if self.episode:
+            season_str = '%sx' % self.season if self.season else ''
+            self.display_name = '%s %s%s' % (self.name, season_str, self.episode)
+        else:
+            self.display_name = self.full_name
+
+    @_profiled('alt', arg=1)
+    def _update_alt(self, alt):
+        '''Update info from the alternate titles.
+        '''
+        if not isinstance(alt, (list, tuple)):
+            alt = [alt]
+        for i_alt in [self.__class__(s_alt, engine=self.engine) for s_alt in alt]:
+            if len(i_alt.rip) > len(self.rip):
+                self.full_name = i_alt.full_name
+                self.name = i_alt.name
+                self.season = i_alt.season
+                self.episode = i_alt.episode
+                self.episode_alt = i_alt.episode_alt
+                self.date = i_alt.date
+                self.rip = i_alt.rip
+                break
+
+            # Update langs
+            self.langs.extend([l for l in i_alt.langs if l not in self.langs])
+
+    def _parse_regex(self, val):
+
         self.full_name = clean(val, 6)
         self.rip = get_rip(val)
         self.date = get_year(val)
@@ -248,7 +782,7 @@ class Title(object):
             self.full_name = clean(val, 7)
 
         # Get audio info
-        res = RE_AUDIO.search(clean(val))
+        res = _search_audio(clean(val))
         if res:
             groups = res.groups()
             self.artist = clean(groups[1], 6)
@@ -261,44 +795,88 @@ class Title(object):
         # Get langs
         self.langs = get_langs(self.rip or val)
 
-        # Set and clean attributes
-        for a, v in self.DEFAULTS.items():
-            if getattr(self, a, None) is None:
-                setattr(self, a, v)
+    def _parse_tokens(self, val):
+        value = clean(val)
+        tokens = tokenize(value)
+        self.full_name = _get_full_name(value, tokens)
+        self.date = _get_year_tokens(tokens)
 
-        # Check alternate items and update info
-        if alt:
-            if not isinstance(alt, (list, tuple)):
-                alt = [alt]
-            for i_alt in [self.__class__(s_alt) for s_alt in alt]:
-                if len(i_alt.rip) > len(self.rip):
-                    self.full_name = i_alt.full_name
-                    self.name = i_alt.name
-                    self.season = i_alt.season
-                    self.episode = i_alt.episode
-                    self.episode_alt = i_alt.episode_alt
-                    self.date = i_alt.date
-                    self.rip = i_alt.rip
-                    break
-
-                # Update langs
-                self.langs.extend([l for l in i_alt.langs if l not in self.langs])
+        index, offset = _find_rip(tokens)
+        self.rip = value[offset:] if index is not None else ''
 
-        # Remove default language if others exist
-        if len(self.langs) > 1 and LANG_DEFAULT in self.langs:
-            self.langs.remove(LANG_DEFAULT)
-
-        # Handle anime episode
-        if self.episode_alt and not is_tv(self.rip):
+        # Get episode info
+        res = None
+        if not is_movies(value) or is_tv(value):
+            res = _get_episode_tokens(value, tokens)
+        if res:
+            sep, self.season, self.episode = res
+            pos = value.find(sep)
+            self.name = ' '.join(RE_WORD_SEP.split(value[:pos].lower().replace("'", ''))).strip()
+            self.episode_alt = sep if sep.isdigit() else ''
+            rip = value[pos + len(sep):].replace('_', ' ')
+            if rip and len(rip) > len(self.rip):
+                self.rip = rip
+                offset = pos + len(sep)
+        else:
+            self.name = self.full_name
             self.season = ''
-            self.episode = self.episode_alt
+            self.episode = ''
+            self.episode_alt = ''
 
-        # Get display name
-        if self.episode:
-            season_str = '%sx' % self.season if self.season else ''
-            self.display_name = '%s %s%s' % (self.name, season_str, self.episode)
+        if not self.season and len(self.episode) < 2:
+            self.full_name = _get_full_name(value, tokens, last_date=True)
+
+        # Get audio info
+        res = _search_audio(value)
+        if res:
+            groups = res.groups()
+            self.artist = _get_full_name(groups[1], tokenize(groups[1]))
+            self.album = _get_full_name(groups[2], tokenize(groups[2]))
+
+        # Get langs
+        if not self.rip:
+            offset = 0
+        langs = set([t.lang for t in tokens if t.lang and t.start >= offset])
+        self.langs = [l for l, r in RE_LANGS if l in langs] or [LANG_DEFAULT]
+
+    @classmethod
+    def set_persistent_cache(cls, file):
+        '''Store parsing results in a sqlite file, or disable it if file is None.
+        '''
+        if cls.persistent_cache:
+            cls.persistent_cache.close()
+        cls.persistent_cache = PersistentCache(file, table='titles') if file else None
+
+    @classmethod
+    def parse(cls, val, alt=None, engine=ENGINE_DEFAULT):
+        '''Get a memoized TitleInfo.
+
+        :param alt: alternate titles (see Title)
+        :param engine: parsing engine (see Title)
+        '''
+        if isinstance(alt, list):
+            alt = tuple(alt)
+        key = (val, alt, engine)
+        res = cls.cache.get(key)
+        if res is not None:
+            return res
+
+        if cls.persistent_cache:
+            key_persistent = '%s:%r' % (PARSE_CACHE_VERSION, key)
+            res = cls.persistent_cache.get(key_persistent)
+            if res is None:
+                res = cls(val, alt, engine=engine).get_info()
+                cls.persistent_cache.set(key_persistent, res)
         else:
-            self.display_name = self.full_name
+            res = cls(val, alt, engine=engine).get_info()
+
+        cls.cache.set(key, res)
+        return res
+
+    def get_info(self):
+        info = dict([(f, getattr(self, f)) for f in TitleInfo._fields])
+        info['langs'] = tuple(info['langs'])
+        return TitleInfo(**info)
 
     def __repr__(self):
         res = {}
@@ -332,64 +910,268 @@ class Title(object):
             return '__all__'
         return None
 
-    def _get_separator_patterns(self, mode, category=None):
+    def _get_separator_patterns(self, mode, category=None, safe=False):
         '''Get words separators patterns.
+
+        :param safe: avoid adjacent overlapping repetitions
+            which can backtrack catastrophically (same matches)
         '''
+        if safe:
+            p_junk = '(%s)' % '|'.join([w for w in LIST_JUNK_SEARCH if w != 's'])
+            p_sep = _get_safe_separators_pattern(1)
+            p_sep_begin = _get_safe_separators_pattern(1, begin=True)
+            p_sep_end = r'[\W_s]*(%s+([\W_]+%s([\W_]%s)*[\W_]*|[\W_]*)|[\W_]%s([\W_]%s)*[\W_]*)?$' % (
+                    PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK, PATTERN_SEP_JUNK, p_junk, PATTERN_SEP_JUNK)
+        else:
+            p_sep = r'[\W_s]*%s*[\W_]*(%s[\W_]+)*' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
+            p_sep_begin = r'[\W_]*%s*[\W_]*(%s[\W_]+)*' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
+            p_sep_end = r'[\W_s]*%s*[\W_]*([\W_]%s)*[\W_]*$' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
+
         if mode == '__lazy__':
             p_begin = r'^.*'
             p_inside = r'.*'
             p_end = r'.*$'
         elif mode == '__all__':
             p_begin = r'(^|^.*[\W_])'
-            p_inside = r'[\W_s]*%s*[\W_]*(%s[\W_]+)*' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
+            p_inside = p_sep
             p_end = r'([\W_].*$|$)'
         else:
-            p_begin = r'^[\W_]*%s*[\W_]*(%s[\W_]+)*' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
-            p_inside = r'[\W_s]*%s*[\W_]*(%s[\W_]+)*' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
+            p_begin = r'^%s' % p_sep_begin
+            p_inside = p_sep
             if self.episode or category == 'tv':
                 p_end = r'([\W_].*$|$)'
             else:
-                p_end = r'[\W_s]*%s*[\W_]*([\W_]%s)*[\W_]*$' % (PATTERN_SEP_EXTRA, PATTERN_SEP_JUNK)
+                p_end = p_sep_end
 
         return p_begin, p_inside, p_end
 
-    def get_search_pattern(self, mode=None, category=None, auto=False):
+    def get_search_words(self):
+        '''Get the words of the search pattern.
+        '''
+        if self.episode:
+            title = '%s %s%s' % (self.name, '%s ' % self.season if self.season else '', self.episode)
+        else:
+            title = self.title
+        return get_words(title)
+
+    def get_search_pattern(self, mode=None, category=None, auto=False, safe=False):
         '''Get a search regex pattern from a query.
 
         :param mode: search mode, possible values:
             - None: exact match
             - __all__: match phrase and other words
             - __lazy__: match all words without boundaries
+        :param safe: rewrite separators to limit backtracking
 
         :return: pattern
         '''
         if auto:
             mode = self._get_search_mode()
 
-        if self.episode:
-            title = '%s %s%s' % (self.name, '%s ' % self.season if self.season else '', self.episode)
-        else:
-            title = self.title
+        p_begin, p_inside, p_end = self._get_separator_patterns(mode, category, safe=safe)
 
-        p_begin, p_inside, p_end = self._get_separator_patterns(mode, category)
-
-        pattern = p_inside.join(get_words(title))
+        pattern = p_inside.join(self.get_search_words())
         pattern = re.sub(r's(%s|$)' % re.escape(p_inside), r"'?s?\1", pattern)
 
         if self.episode:
             s_prev, e_prev = self._get_prev_episode()
-            p_year = '(\d{4})?%s' % p_inside
+            p_sep = re.escape(p_inside)
+            # an optional year between 2 separators can split their match
+            # in many ways, safe patterns match the separators at once
+            safe_seps = safe and mode != '__lazy__'
             if self.season:
-                pattern = re.sub(r'(0?%s)%s(%s)' % (self.season, re.escape(p_inside), self.episode),
-                        r'%s([^1-9]{,3}%s\D*%s\D[^1-9]*\1?\D*\2|[^1-9]{,3}\1\D*\2)' % (p_year, s_prev, e_prev),
+                if safe_seps:
+                    p_seps = r'(?:%s\d{4}%s|%s)' % (p_inside, p_inside, _get_safe_separators_pattern(2))
+                else:
+                    p_seps = r'%s(\d{4})?%s' % (p_inside, p_inside)
+                pattern = re.sub(r'%s(0?%s)%s(%s)' % (p_sep, self.season, p_sep, self.episode),
+                        r'%s([^1-9]{,3}%s\D*%s\D[^1-9]*\1?\D*\2|[^1-9]{,3}\1\D*\2)' % (p_seps, s_prev, e_prev),
                         pattern)
             else:
-                pattern = re.sub(r'(%s)(%s)' % (re.escape(p_inside), self.episode),
-                        r'%s\1([^1-9]{,3}%s[^1-9]{,3}\2|[^1-9]{,3}\2)' % (p_year, e_prev),
+                if safe_seps:
+                    p_seps = r'(?:\d{4})?%s' % _get_safe_separators_pattern(2)
+                else:
+                    p_seps = r'(\d{4})?%s%s' % (p_inside, p_inside)
+                pattern = re.sub(r'%s(%s)' % (p_sep, self.episode),
+                        r'%s([^1-9]{,3}%s[^1-9]{,3}\1|[^1-9]{,3}\1)' % (p_seps, e_prev),
                         pattern)
 
         return r'%s%s%s' % (p_begin, pattern, p_end)
 
-    def get_search_re(self, mode=None, category=None, auto=False):
-        pattern = self.get_search_pattern(mode, category=category, auto=auto)
-        return re.compile(pattern, re.I)
+    def get_search_re(self, mode=None, category=None, auto=False, safe=False):
+        '''Get a compiled search regex, cached by the values the pattern
+        is built from (search words, season, episode, mode, category).
+        '''
+        if auto:
+            mode = self._get_search_mode()
+        key = (tuple(self.get_search_words()), self.season, self.episode,
+                mode, category, safe)
+        res = self.search_cache.get(key)
+        if res is None:
+            pattern = self.get_search_pattern(mode, category=category, safe=safe)
+            res = re.compile(pattern, re.I)
+            self.search_cache.set(key, res)
+        return res
+
+
+def get_search_re(query, mode=None, category=None, auto=False, safe=False):
+    '''Get a cached compiled search regex without parsing
+    the query when it is already cached.
+    '''
+    key = (query, ENGINE_DEFAULT, mode, category, auto, safe)
+    res = Title.search_cache.get(key)
+    if res is None:
+        pattern = Title(query).get_search_pattern(mode, category=category, auto=auto, safe=safe)
+        res = re.compile(pattern, re.I)
+        Title.search_cache.set(key, res)
+    return res
+
+def search(re_search, val, timer=None):
+    '''Search a title with a search regex.
+
+    :param timer: SearchTimer object
+    '''
+    if timer:
+        return timer.search(re_search, val)
+    return re_search.search(val)
+
+def match_queries(val, queries, mode=None, category=None, auto=False,
+        safe=False, timer=None):
+    '''Get the queries matching the title.
+
+    :param queries: queries strings
+    :param safe: use safe search patterns (see Title.get_search_pattern())
+    :param timer: SearchTimer object
+    :return: matching queries list
+    '''
+    return [q for q in queries if search(get_search_re(q, mode, category, auto, safe),
+            val, timer=timer)]
+
+
+class SearchTimer(object):
+    '''Record the match time of search regexes.
+    '''
+    def __init__(self):
+        self.stats = {}
+
+    def search(self, re_search, val):
+        begin = time.time()
+        res = re_search.search(val)
+        duration = time.time() - begin
+
+        stat = self.stats.setdefault(re_search.pattern,
+                {'count': 0, 'total': 0, 'max': 0, 'slowest': None})
+        stat['count'] += 1
+        stat['total'] += duration
+        if duration >= stat['max']:
+            stat['max'] = duration
+            stat['slowest'] = val
+        return res
+
+    def get_slowest(self, limit=10):
+        '''Get the stats of the patterns with the longest match time.
+
+        :return: list of (pattern, stat) tuples
+        '''
+        return sorted(self.stats.items(), key=lambda x: x[1]['max'], reverse=True)[:limit]
+
+    def clear(self):
+        self.stats.clear()
+
+
+class QuerySet(object):
+    '''Search queries matched at once against titles.
+
+    Queries are indexed by the first word of their search pattern,
+    so only the queries whose first word begins a word of the title
+    are checked with their search regex.
+    '''
+    def __init__(self, queries=None, mode=None, category=None, auto=False,
+            safe=False, timer=None):
+        self.safe = safe
+        self.timer = timer
+        self.entries = []
+        self.index = {}
+        self.unindexed = []
+        for query in queries or []:
+            self.add(query, mode=mode, category=category, auto=auto)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get_key(self, title, mode, auto):
+        if auto:
+            mode = title._get_search_mode()
+        if mode == '__lazy__':
+            return
+
+        words = title.get_search_words()
+        if not words or not words[0]:
+            return
+        word = words[0]
+        if title.episode and word.isdigit():    # season and episode are rewritten
+            return
+        if len(word) > 1 and word.endswith('s'):    # trailing 's' is optional
+            word = word[:-1]
+        return word
+
+    def add(self, query, mode=None, category=None, auto=False):
+        title = Title(query)
+        id = len(self.entries)
+        self.entries.append((query, title.get_search_re(mode,
+                category=category, auto=auto, safe=self.safe)))
+
+        key = self._get_key(title, mode, auto)
+        if key is None:
+            self.unindexed.append(id)
+        else:
+            self.index.setdefault(key, []).append(id)
+
+    def _get_candidates(self, val):
+        ids = set(self.unindexed)
+        for word in RE_WORD_SEP.split(val.lower()):
+            for i in range(1, len(word) + 1):
+                ids.update(self.index.get(word[:i], []))
+        return sorted(ids)
+
+    def match(self, val):
+        '''Get the queries matching the title.
+        '''
+        res = []
+        for id in self._get_candidates(val):
+            query, re_search = self.entries[id]
+            if search(re_search, val, timer=self.timer):
+                res.append(query)
+        return res
+
+
+def _parse_item(item):
+    if isinstance(item, tuple):
+        return Title.parse(*item)
+    return Title.parse(item)
+
+def parse_many(iterable, workers=None, chunksize=PARSE_MANY_CHUNKSIZE,
+        min_items=PARSE_MANY_MIN_ITEMS):
+    '''Iterate TitleInfo objects in the input order.
+
+    :param iterable: titles or (title, alt) tuples
+    :param workers: number of processes (defaults to the number of CPUs)
+    :param min_items: minimum number of items to use a process pool
+    '''
+    iterable = iter(iterable)
+    head = list(islice(iterable, min_items))
+    if workers is None:
+        workers = cpu_count()
+    if workers <= 1 or len(head) < min_items:
+        for item in chain(head, iterable):
+            yield _parse_item(item)
+        return
+
+    pool = Pool(workers)
+    try:
+        for res in pool.imap(_parse_item, chain(head, iterable), chunksize):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,4 +1,9 @@
+import os
 import re
+import sqlite3
+import threading
+import cPickle as pickle
+from collections import OrderedDict
 
 
 def split_words(s, sep=r'[\W_]+'):
@@ -21,3 +26,119 @@ def in_range(n, val_min=None, val_max=None):
     elif val_max and n > val_max:
         return False
     return True
+
+
+class LRUCache(object):
+    '''Bounded least recently used cache, safe to share between threads.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                val = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = val
+            self.hits += 1
+            return val
+
+    def set(self, key, val):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = val
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            }
+
+
+class PersistentCache(object):
+    '''Sqlite backed key/value store for picklable values,
+    safe to share between threads.
+    '''
+    def __init__(self, file, table='cache'):
+        self.file = file
+        self.table = table
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        # Do not share a connection with a forked process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.file, isolation_level=None,
+                    check_same_thread=False)
+            self._conn.execute('PRAGMA synchronous=OFF')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB)' % self.table)
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key, default=None):
+        with self._lock:
+            res = self.conn.execute('SELECT value FROM %s WHERE key=?' % self.table, (key,)).fetchone()
+        if res is None:
+            return default
+        return pickle.loads(str(res[0]))
+
+    def get_many(self, keys, chunk_size=500):
+        '''Get the values of the existing keys.
+
+        :return: dict
+        '''
+        keys = list(keys)
+        res = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            query = 'SELECT key, value FROM %s WHERE key IN (%s)' % (self.table, ','.join('?' * len(chunk)))
+            with self._lock:
+                rows = self.conn.execute(query, chunk).fetchall()
+            for key, val in rows:
+                res[key] = pickle.loads(str(val))
+        return res
+
+    def set(self, key, val):
+        self.set_many([(key, val)])
+
+    def set_many(self, items):
+        '''Store an iterable of (key, value) in a single transaction.
+        '''
+        data = [(k, sqlite3.Binary(pickle.dumps(v, pickle.HIGHEST_PROTOCOL))) for k, v in items]
+        with self._lock, self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)' % self.table, data)
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM %s' % self.table)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -1,34 +1,140 @@
 #!/usr/bin/env python
+import os
+import re
+import random
+import pickle
+import shutil
+import tempfile
 import unittest
 import logging
+import mimetypes
+import time
+import threading
+import zipfile
+import tarfile
+from contextlib import closing
+from StringIO import StringIO
 
 from mock import patch, Mock
+from lxml import html
+import trans
 
-from filetools.title import Title, clean, get_episode_info, get_size
+from filetools.title import (Title, clean, get_episode_info, get_size,
+        get_rip, parse_many, match_queries, QuerySet, SearchTimer, profile,
+        _get_rip_patterns, _clean, _clean_special, _clean_cache,
+        RE_CONTROL_CHARS, RE_NO_BREAK_SPACES)
+from filetools import media
+from filetools import mediainfo
+from filetools import download
+from filetools.inotify import Inotify, IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR
+from filetools.media import (Entry, iter_entries, iter_files, files, fsplit,
+        get_type, get_file_type, get_file, Media, FileInfoIndex,
+        unpack_zip, unpack_tar, ArchiveError, BadArchiveError, UnsupportedArchiveError,
+        ARCHIVE_DEF)
 
 
 logging.basicConfig(level=logging.DEBUG)
 
+MEDIAINFO_STUB = '''#!/bin/sh
+# Print the content of the files as their mediainfo output
+[ -n "$MEDIAINFO_STUB_DELAY" ] && sleep "$MEDIAINFO_STUB_DELAY"
+status=0
+for file in "$@"; do
+    case "$file" in -*) continue;; esac
+    case "$file" in *.slow.*) exec sleep 10;; esac
+    if [ ! -f "$file" ]; then
+        status=1
+        continue
+    fi
+    echo "General"
+    echo "Complete name : $file"
+    cat "$file"
+    echo
+done
+exit $status
+'''
+MEDIAINFO_OUTPUT = '''Duration : %(duration)s
+Overall bit rate : 1500000
+Performer : Artist Name
+Album : Album Name
+
+Video
+Bit rate : 1200000
+Codec : AVC
+Codec ID : avc1
+
+Audio #1
+Bit rate : 128000
+Codec : AAC
+Codec ID : 40
+'''
+
+
+def make_mediainfo_stub(path):
+    '''Create a mediainfo stub binary in the path.
+    '''
+    file = os.path.join(path, 'mediainfo')
+    with open(file, 'w') as fd:
+        fd.write(MEDIAINFO_STUB)
+    os.chmod(file, 0755)
+    return file
+
+def make_media_files(path, count):
+    '''Create media files containing their mediainfo output.
+    '''
+    res = []
+    for i in range(count):
+        res.append(os.path.join(path, 'show.name.s01e%02d.mkv' % i))
+        with open(res[-1], 'w') as fd:
+            fd.write(MEDIAINFO_OUTPUT % {'duration': 60000 + i})
+    return res
+
 
 #
 # Title
 #
 
-# TODO
-# class TitleCleanTest(unittest.TestCase):
+class TitleCleanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = [
+            'Artist_Name_-_Album_Name_-_2012_-_TEAM',
+            '  show name \r\n s01e02 ',
+            'movie name [2012] (TEAM)',
+            'Tom & Jerry',
+            'a &amp; b&nbsp;c',
+            '<b>movie</b> name',
+            'caf\xc3\xa9 name',
+            u'caf\xe9 name',
+            '\x01name\x7f',
+            '   ',
+            ]
+        self.fixtures += generate_titles(SEPS, count=300)
+        _clean_cache.clear()
+
+    def _clean_special_reference(self, val):
+        val = RE_CONTROL_CHARS.sub('', val)
+        val = RE_NO_BREAK_SPACES.sub(' ', val)
+        try:
+            val = html.tostring(html.fromstring(val), method='text', encoding=unicode)
+        except Exception:
+            pass
+        if not isinstance(val, unicode):
+            val = val.decode('utf-8')
+        return str(val.encode('trans')).strip()
 
-#     def setUp(self):
-#         self.fixtures = [
-#             ('Artist_Name_-_Album_Name_-_2012_-_TEAM',
-#                 'artist name', 'album name', 2012),
-#             ('Artist_Name-Album_Name-2012-TEAM',
-#                 'artist name', 'album name', 2012),
-#             ('07-Artist_Name-Album_Name.mp3',
-#                 'artist name', 'album name', 2012),
-#             ]
+    def test_clean_special(self):
+        for val in self.fixtures:
+            self.assertEqual(_clean_special(val), self._clean_special_reference(val), repr(val))
 
-#     def test_clean_special(self):
-#         pass
+    def test_cache(self):
+        for level in (0, 9):
+            for val in self.fixtures:
+                self.assertEqual(clean(val, level), _clean(val, level))
+        hits = _clean_cache.hits
+        for val in self.fixtures:
+            clean(val, 9)
+        self.assertEqual(_clean_cache.hits, hits + len(self.fixtures))
 
 
 class TitleMovieTest(unittest.TestCase):
@@ -224,6 +330,320 @@ class TitleSearchTest(unittest.TestCase):
             self.assertFalse(res.search(title), '"%s" (%s) should not match "%s"' % (query, res.pattern, title))
 
 
+WORDS = ['show', 'name', 'the', '2012', 's01e02', '3x02', '302',
+        'part', 'cd1', 'dvd', 'pal', '720p', '1080i', 'bluray', 'blu ray',
+        'ts', 'cam', 'r5', 'dvdrip', 'dvdscr', 'bdrip', 'webrip', 'hdtv',
+        'pdtv', 'tvrip', 'ac3', 'xvid', 'x264', 'h264', 'hd', 'ws', 'limited',
+        'proper', 'multi', 'repack', 'english', 'french', 'vostfr', 'vf',
+        'subfrench', 'ita', 'german', 'arabic', 'spanish', 'esp', 'nl',
+        '[team]', '(2011)', '{x}', '-team']
+WORDS_LANGS = ['eng', 'sub', 'subs', 'subtitles', 'eng.subs', 'french subs',
+        'truefrench', 'fr', '[eztv]', '[eztv', '(2010', '[', 'Movie']
+SEPS = [' ', '.', '_', '-', ' - ']
+
+
+def generate_titles(seps, count=3000, words=WORDS):
+    rand = random.Random(0)
+    res = []
+    for i in range(count):
+        sep = rand.choice(seps)
+        res.append(sep.join([rand.choice(words)
+                for j in range(rand.randint(1, 8))]))
+    return res
+
+
+class TitleRipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = []
+        for cl in (TitleMovieTest, TitleTvTest):
+            test = cl('setUp')
+            test.setUp()
+            self.fixtures += [f[0] for f in test.fixtures]
+
+        self.fixtures += generate_titles(SEPS + [''])
+
+    def _get_rip_sequential(self, val):
+        rips = []
+        for pattern in _get_rip_patterns():
+            res = re.compile(r'[\W_]%s([\W_].*$|$)' % pattern, re.I).search(val)
+            if res:
+                rips.append(res.group(0))
+        if rips:
+            return max(rips, key=len)
+        return ''
+
+    def test_rip(self):
+        for val in self.fixtures:
+            self.assertEqual(get_rip(val), self._get_rip_sequential(val), val)
+
+
+class TitleTokensTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = []
+        for cl in (TitleMovieTest, TitleTvTest):
+            test = cl('setUp')
+            test.setUp()
+            self.fixtures += [f[0] for f in test.fixtures]
+        self.fixtures += generate_titles(SEPS)
+        self.fixtures += generate_titles(SEPS, words=WORDS + WORDS_LANGS)
+        self.fixtures += [
+            'Movie.Name.2010.ENG.subs.PROPER.DVDRip.XviD-TEAM',
+            'Show.Name.S01E02.french.subs-fr.HDTV.XviD-[eztv]',
+            'movie name (2010 [eztv] DVDRip',
+            'proper fr [ esp vf blu ray',
+            ]
+
+        self.fixtures_alt = [
+            ('05-video_name', ['VOSTFR HDTV', 'show name s01e05']),
+            ('video_name', ['show.name.s01e05.720p.HDTV.x264-TEAM', 'show name']),
+            ('cd1', 'movie name 2012 FRENCH DVDrip XviD TEAM'),
+            ]
+
+    def _check_title(self, val, alt=None):
+        res = Title(val, alt, engine='tokens')
+        expected = Title(val, alt)
+
+        for attr in Title.DEFAULTS:
+            self.assertEqual(getattr(res, attr), getattr(expected, attr),
+                    '%s: "%s" != "%s" for "%s"' % (attr, getattr(res, attr), getattr(expected, attr), val))
+
+    def test_conformance(self):
+        for val in self.fixtures:
+            self._check_title(val)
+
+    def test_conformance_alt(self):
+        for val, alt in self.fixtures_alt:
+            self._check_title(val, alt)
+
+
+class TitleParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = [
+            ('show name s03e02 HDTV XviD TEAM', None),
+            ('movie name 2012 DVDrip XviD TEAM', None),
+            ('05-video_name', ['VOSTFR HDTV', 'show name s01e05']),
+            ]
+        Title.cache.clear()
+        Title.set_persistent_cache(None)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        Title.set_persistent_cache(None)
+        shutil.rmtree(self.path)
+
+    def _check_info(self, info, title):
+        for attr in info._fields:
+            expected = getattr(title, attr)
+            if attr == 'langs':
+                expected = tuple(expected)
+            self.assertEqual(getattr(info, attr), expected)
+
+    def test_parse(self):
+        for val, alt in self.fixtures:
+            self._check_info(Title.parse(val, alt), Title(val, alt))
+
+    def test_cache(self):
+        for val, alt in self.fixtures:
+            Title.parse(val, alt)
+            Title.parse(val, alt)
+
+        info = Title.cache.info()
+        self.assertEqual(info['misses'], len(self.fixtures))
+        self.assertEqual(info['hits'], len(self.fixtures))
+
+    def test_persistent_cache(self):
+        file = os.path.join(self.path, 'titles.db')
+        Title.set_persistent_cache(file)
+        expected = [Title.parse(val, alt) for val, alt in self.fixtures]
+
+        Title.cache.clear()
+        Title.set_persistent_cache(file)
+        with patch.object(Title, '__init__') as mock_init:
+            res = [Title.parse(val, alt) for val, alt in self.fixtures]
+            self.assertFalse(mock_init.called)
+        self.assertEqual(res, expected)
+
+
+class ParseManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = [
+            'show name s03e02 HDTV XviD TEAM',
+            'movie name 2012 DVDrip XviD TEAM',
+            ('05-video_name', ('VOSTFR HDTV', 'show name s01e05')),
+            'anime name 302',
+            ] * 10
+
+    def _get_expected(self):
+        return [Title.parse(*i) if isinstance(i, tuple) else Title.parse(i) for i in self.fixtures]
+
+    def test_in_process(self):
+        res = list(parse_many(iter(self.fixtures), workers=4))
+
+        self.assertEqual(res, self._get_expected())
+
+    def test_pool(self):
+        res = list(parse_many(iter(self.fixtures), workers=2, chunksize=3, min_items=5))
+
+        self.assertEqual(res, self._get_expected())
+
+
+class SearchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = [
+            ('show name 1x23', 'show name s01e23 episode title', True),
+            ('show name 1x23', 'show name s02e23 episode title', False),
+            ('other show', 'the.other.show', True),
+            ('show name', 'SHOW NAME', True),
+            ('show name', 'that.show.name.', False),
+            ]
+        Title.search_cache.clear()
+
+    def test_cache(self):
+        title = Title('show name 1x23')
+        res = title.get_search_re()
+
+        self.assertTrue(title.get_search_re() is res)
+        self.assertTrue(Title('show name 1x23').get_search_re() is res)
+        self.assertFalse(title.get_search_re(mode='__all__') is res)
+        self.assertEqual(Title.search_cache.info()['hits'], 2)
+
+    def test_cache_alt(self):
+        res = Title('01.mkv').get_search_re()
+        title = Title('01.mkv', alt='Show.Name.S02E01.HDTV')
+        res_alt = title.get_search_re()
+        self.assertFalse(res_alt is res)
+        self.assertEqual(res_alt.pattern, title.get_search_pattern())
+        self.assertTrue(res_alt.search('show name s02e01'))
+
+    def test_match_queries(self):
+        queries = sorted(set([q for q, t, m in self.fixtures]))
+        for query, title, match in self.fixtures:
+            res = match_queries(title, queries)
+
+            self.assertEqual(query in res, match, '"%s" should%s match "%s"' % (query, '' if match else ' not', title))
+            for query_ in res:
+                self.assertTrue(Title(query_).get_search_re().search(title))
+
+
+class QuerySetTest(unittest.TestCase):
+
+    def setUp(self):
+        test = TitleSearchTest('setUp')
+        test.setUp()
+        self.fixtures = []
+        for attr in ('fixtures_tv', 'fixtures_tv_err', 'fixtures_movies', 'fixtures_movies_err'):
+            self.fixtures += getattr(test, attr)
+        self.queries = sorted(set([q for q, t in self.fixtures])) + [
+            'shows name', '1x23', 'the show name', '.show.name.']
+        self.titles = [t for q, t in self.fixtures] + generate_titles(SEPS, count=200)
+
+    def test_match(self):
+        for mode in (None, '__all__', '__lazy__'):
+            query_set = QuerySet(self.queries, mode=mode)
+            for title in self.titles:
+                expected = [q for q in self.queries if Title(q).get_search_re(mode).search(title)]
+
+                self.assertEqual(query_set.match(title), expected, title)
+
+    def test_index(self):
+        query_set = QuerySet(self.queries)
+
+        self.assertTrue('show' in query_set.index)
+        self.assertEqual(query_set._get_candidates('other title'), query_set.unindexed)
+
+
+class SafeSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        test = QuerySetTest('setUp')
+        test.setUp()
+        self.queries = test.queries
+        self.titles = test.titles + ['show name' + ' ' * 20, 'show' + '.s' * 20 + 'name',
+                'show [a] (b) name', 'the show name (x) the', 'show name 1x23' + '.' * 20,
+                '[a] the (b) show name', 'show name [a] the [b] 1x23', 'show name (2010) 1x23',
+                'show name 2010 s01e23', 'show name.s.[a].the.1x23', 'show name us(sthe) 1x23']
+
+    def test_safe_patterns(self):
+        for query in self.queries:
+            for mode in (None, '__all__'):
+                for category in (None, 'tv'):
+                    title = Title(query)
+                    re_search = title.get_search_re(mode, category=category)
+                    re_safe = title.get_search_re(mode, category=category, safe=True)
+                    for val in self.titles:
+                        self.assertEqual(bool(re_search.search(val)), bool(re_safe.search(val)),
+                                '%s, %s: "%s" on "%s"' % (mode, category, query, val))
+
+    def test_safe_long_titles(self):
+        queries = ['show name', 'show name 1x23', 'the show name']
+        for val, expected in [
+                ('show name' + ' ' * 300, ['show name', 'the show name']),
+                ('show name' + '[a]' * 300, ['show name', 'the show name']),
+                ('show name' + '[a]' * 300 + ' 1x23', ['show name 1x23']),
+                ('[a]' * 300 + 'the show name 1x23', ['show name 1x23']),
+                ('show name' + '.s' * 300 + '.1x2', []),
+                ]:
+            self.assertEqual(match_queries(val, queries, safe=True), expected)
+
+    def test_timer(self):
+        timer = SearchTimer()
+        query_set = QuerySet(self.queries, timer=timer)
+        for val in self.titles:
+            query_set.match(val)
+
+        res = timer.get_slowest(limit=3)
+        self.assertEqual(len(res), 3)
+        self.assertTrue(res[0][1]['max'] >= res[1][1]['max'] >= res[2][1]['max'])
+        self.assertTrue(res[0][1]['slowest'] in self.titles)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = [
+            ('show name s03e02 HDTV XviD TEAM', None),
+            ('artist name - album name - 2012', None),
+            ('05-video_name', ['VOSTFR HDTV', 'show name s01e05']),
+            ]
+        _clean_cache.clear()
+
+    def test_profile(self):
+        with profile() as profiler:
+            for val, alt in self.fixtures:
+                Title(val, alt)
+
+        stats = profiler.stats
+        for name in ('title', 'clean', 'get_rip', 'get_episode_info', 'audio', 'alt'):
+            self.assertTrue(name in stats, name)
+        self.assertEqual(stats['title']['count'], 5)
+        self.assertEqual(stats['alt']['count'], 1)
+        self.assertEqual(stats['alt']['slowest'][0][1], self.fixtures[2][1])
+        for stat in stats.values():
+            self.assertTrue(len(stat['slowest']) <= min(stat['count'], profiler.slowest_count))
+            durations = [d for d, v in stat['slowest']]
+            self.assertEqual(durations, sorted(durations, reverse=True))
+            self.assertEqual(durations[0], stat['max'])
+
+        report = profiler.get_report()
+        self.assertTrue('get_episode_info' in report)
+        self.assertTrue(repr(self.fixtures[0][0]) in report)
+
+    def test_disabled(self):
+        with profile() as profiler:
+            with profile() as profiler_inner:
+                Title(self.fixtures[0][0])
+            Title(self.fixtures[1][0])
+        Title(self.fixtures[2][0])
+
+        self.assertEqual(profiler_inner.stats['title']['count'], 1)
+        self.assertEqual(profiler.stats['title']['count'], 1)
+
+
 class SizeTest(unittest.TestCase):
 
     def setUp(self):
@@ -248,5 +668,850 @@ class SizeTest(unittest.TestCase):
             self.assertEqual(res, expected)
 
 
+
+#
+# Media
+#
+
+class IterEntriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for dir in ('movie name', 'show name/season 1', 'empty.dir.name'):
+            os.makedirs(os.path.join(self.path, dir))
+        for file in ('movie name/movie.name.avi', 'movie name/movie.name.srt',
+                'show name/season 1/show.name.s01e01.mkv', 'show name/show.name.nfo',
+                'file.longext'):
+            with open(os.path.join(self.path, file), 'w') as fd:
+                fd.write('x' * 2048)
+        os.symlink(os.path.join(self.path, 'show name'), os.path.join(self.path, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _walk(self, topdown):
+        res = []
+        for path, dirs, files_ in os.walk(self.path, topdown=topdown):
+            res += [os.path.join(path, f) for f in dirs + files_]
+        return res
+
+    def test_iter_files(self):
+        for topdown in (True, False):
+            res = list(iter_files(self.path, incl_dirs=True, topdown=topdown))
+            self.assertEqual(res, self._walk(topdown))
+
+    def test_iter_files_not_recursive(self):
+        res = list(iter_files(self.path, incl_dirs=True, recursive=False))
+        self.assertEqual(sorted(res), sorted([os.path.join(self.path, f)
+                for f in os.listdir(self.path)]))
+
+    def test_iter_files_parallel(self):
+        for topdown in (True, False):
+            res = list(iter_files(self.path, incl_dirs=True, topdown=topdown, workers=4))
+            self.assertEqual(res, self._walk(topdown))
+
+        res = list(iter_files(self.path, incl_dirs=True, topdown=True, workers=4, ordered=False))
+        self.assertEqual(sorted(res), sorted(self._walk(True)))
+        for i, file in enumerate(res):
+            parent = os.path.dirname(file)
+            if parent != self.path:
+                self.assertTrue(parent in res[:i], file)
+
+    def test_iter_files_parallel_bounded(self):
+        path = os.path.join(self.path, 'tree')
+        for i in range(20):
+            for j in range(10):
+                os.makedirs(os.path.join(path, 'dir%d' % i, 'sub%d' % j))
+        workers = 2
+        for ordered in (True, False):
+            with patch.object(media, '_scandir', wraps=media._scandir) as mock_scandir:
+                walk = iter_files(path, incl_dirs=True, topdown=True,
+                        workers=workers, ordered=ordered)
+                next(walk)
+                time.sleep(.2)
+                self.assertTrue(mock_scandir.call_count <= 2 + media.WALK_PENDING_PER_WORKER * workers,
+                        mock_scandir.call_count)
+                res = [next(walk)] + list(walk)
+                self.assertEqual(mock_scandir.call_count, 1 + 20 * 11)
+            self.assertEqual(len(res), 20 * 11 - 1)
+
+    def test_entry(self):
+        for entry in iter_entries(self.path, incl_dirs=True):
+            self.assertTrue(isinstance(entry, Entry))
+            self.assertEqual(fsplit(entry), fsplit(entry.file))
+            self.assertEqual(get_type(entry), get_type(entry.file))
+            self.assertEqual(entry.is_dir(), os.path.isdir(entry.file))
+            if not entry.is_dir():
+                self.assertEqual(entry.stat().st_size, 2048)
+
+    def test_files(self):
+        res = dict([(f.file, f) for f in files(self.path, types='video')])
+        self.assertEqual(sorted(res), sorted([
+                os.path.join(self.path, 'movie name/movie.name.avi'),
+                os.path.join(self.path, 'show name/season 1/show.name.s01e01.mkv'),
+                ]))
+        self.assertEqual(list(files(self.path, size_min=1)), [])
+
+        res_entry = [f.file for f in files(Entry(self.path), types='video')]
+        self.assertEqual(sorted(res_entry), sorted(res))
+        self.assertEqual(list(files(Entry(os.path.join(self.path, 'missing')))), [])
+
+    def test_file(self):
+        file = os.path.join(self.path, 'movie name/movie.name.avi')
+        real_file = os.path.join(self.path, 'movie name/movie.name.srt')
+        res = get_file(file)
+        self.assertFalse(hasattr(res, '__dict__'))
+        self.assertEqual((res.file, res.type, res.path, res.filename, res.ext, res.dir),
+                (file, 'video', os.path.dirname(file), 'movie.name', '.avi', 'movie name'))
+        self.assertEqual(getattr(res, 'real_ext', res.ext), '.avi')
+
+        res = get_file(file, real_file=real_file)
+        self.assertEqual((res.real_file, res.real_path, res.real_filename, res.real_ext),
+                (real_file, os.path.dirname(real_file), 'movie.name', '.srt'))
+        self.assertEqual(res.type, 'subtitles')
+
+    def test_pickle(self):
+        real_file = os.path.join(self.path, 'movie name/movie.name.srt')
+        objs = list(files(self.path, incl_dirs=True)) \
+                + list(iter_entries(self.path, incl_dirs=True)) \
+                + [get_file(self.path, real_file=real_file)]
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for obj in objs:
+                res = pickle.loads(pickle.dumps(obj, protocol))
+                self.assertEqual((res.__class__, res.file), (obj.__class__, obj.file))
+                if isinstance(obj, media.File):
+                    self.assertEqual((getattr(res, 'real_file', None), res.type),
+                            (getattr(obj, 'real_file', None), obj.type))
+
+    def test_files_filters(self):
+        all_files = list(files(self.path, incl_dirs=True))
+        for kwargs, check in [
+                ({'re_ext': re.compile(r'avi|mkv')}, lambda f: f.ext in ('.avi', '.mkv')),
+                ({'re_path': re.compile(r'season'), 'types': 'video'},
+                    lambda f: 'season' in f.path and f.type == 'video'),
+                ({'re_filename': re.compile(r'^show'), 'size_max': 1},
+                    lambda f: f.filename.startswith('show')),
+                ({'re_file': re.compile(r'name'), 'size_min': 1}, lambda f: False),
+                ]:
+            res = [f.file for f in files(self.path, incl_dirs=True, **kwargs)]
+            self.assertEqual(res, [f.file for f in all_files if check(f)], kwargs)
+
+
+class OpenFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = []
+        for name in ('file1', 'dir1/file2', 'dir2/file3'):
+            self.files.append(os.path.join(self.path, name))
+            if not os.path.exists(os.path.dirname(self.files[-1])):
+                os.makedirs(os.path.dirname(self.files[-1]))
+            with open(self.files[-1], 'w') as fd:
+                fd.write('data')
+        self.candidates = [os.path.join(self.path, n) for n in ('file1', 'dir1', 'dir2')]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_open_files(self):
+        with open(self.files[1]) as fd:
+            self.assertTrue(self.files[1] in media.get_open_files())
+        self.assertFalse(self.files[1] in media.get_open_files())
+
+    def test_get_open_files_lsof(self):
+        with patch.object(media, 'PROC_PATH', os.path.join(self.path, 'missing')):
+            with open(self.files[1]) as fd:
+                with patch.object(media, 'popen', wraps=media.popen) as mock_popen:
+                    res = media.get_open_files()
+                mock_popen.assert_called_once_with(['lsof', '-F', 'n'])
+                self.assertTrue(self.files[1] in res)
+
+            # lsof is not installed
+            with patch.object(media, 'popen', return_value=(None, None, None)):
+                self.assertEqual(media.get_open_files(), set())
+
+    def test_get_open(self):
+        self.assertEqual(media.get_open(self.candidates, check_mtime=False), set())
+        with open(self.files[1]) as fd:
+            res = media.get_open(self.candidates, check_mtime=False)
+            self.assertEqual(res, set([self.candidates[1]]))
+            self.assertTrue(media.is_file_open(self.files[1], check_mtime=False))
+        self.assertFalse(media.is_file_open(self.candidates[1], check_mtime=False))
+
+    def test_get_open_symlink(self):
+        link = os.path.join(self.path, 'dir2', 'link')
+        os.symlink(self.files[0], link)
+        with open(self.files[0]) as fd:
+            res = media.get_open(self.candidates[1:], check_mtime=False)
+        self.assertEqual(res, set([self.candidates[2]]))
+
+    def test_get_open_mtime(self):
+        def modify():
+            with open(self.files[2], 'a') as fd:
+                fd.write('more data')
+            os.utime(self.files[2], (time.time() + 10, time.time() + 10))
+
+        timer = threading.Timer(.2, modify)
+        timer.start()
+        begin = time.time()
+        try:
+            res = media.get_open(self.candidates, mtime_delta=.5)
+        finally:
+            timer.cancel()
+        self.assertTrue(time.time() - begin < 1)
+        self.assertEqual(res, set([self.candidates[2]]))
+
+
+class InotifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.inotify = Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        self.inotify.add_watch(self.path, IN_CLOSE_WRITE | IN_CREATE)
+        self.assertEqual(self.inotify.read(0), [])
+        with open(os.path.join(self.path, 'file'), 'w') as fd:
+            fd.write('data')
+        os.mkdir(os.path.join(self.path, 'dir'))
+        res = self.inotify.read(1)
+        self.assertEqual(res, [(self.path, IN_CREATE, 'file'),
+                (self.path, IN_CLOSE_WRITE, 'file'),
+                (self.path, IN_CREATE | IN_ISDIR, 'dir')])
+
+    def test_remove_watch(self):
+        wd = self.inotify.add_watch(self.path, IN_CREATE)
+        self.inotify.remove_watch(wd)
+        os.mkdir(os.path.join(self.path, 'dir'))
+        self.assertEqual(self.inotify.read(.1), [])
+
+
+class UnpackDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.download = os.path.join(self.path, 'download')
+        os.makedirs(self.download)
+        for i in range(3):
+            with open(os.path.join(self.download, 'file%d.txt' % i), 'w') as fd:
+                fd.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_nested(self, names, data='data'):
+        '''Create archives nested in the names order, the last one
+        containing a text file.
+        '''
+        for i, name in reversed(list(enumerate(names))):
+            buf = StringIO()
+            if name.endswith('.zip'):
+                with zipfile.ZipFile(buf, 'w') as zf:
+                    zf.writestr('sub%d/file.txt' % i, data)
+                    if i + 1 < len(names):
+                        zf.writestr('sub%d/%s' % (i, names[i + 1]), next_data)
+            else:
+                with closing(tarfile.open(fileobj=buf, mode='w:gz')) as tf:
+                    members = [('sub%d/file.txt' % i, data)]
+                    if i + 1 < len(names):
+                        members.append(('sub%d/%s' % (i, names[i + 1]), next_data))
+                    for member, member_data in members:
+                        info = tarfile.TarInfo(member)
+                        info.size = len(member_data)
+                        tf.addfile(info, StringIO(member_data))
+            next_data = buf.getvalue()
+        with open(os.path.join(self.download, names[0]), 'wb') as fd:
+            fd.write(next_data)
+
+    def test_unpack_nested(self):
+        names = ['a.zip', 'b.zip', 'c.tar.gz', 'd.zip', 'e.tgz']
+        self.make_nested(names)
+        with patch.object(media, '_walk', wraps=media._walk) as mock_walk:
+            res = download.unpack_download(self.download)
+        self.assertEqual(res, self.download)
+        self.assertEqual(mock_walk.call_count, 1)
+
+        files = sorted(iter_files(self.download))
+        self.assertEqual(files, sorted([os.path.join(self.download, 'file%d.txt' % i) for i in range(3)]
+                + [os.path.join(self.download, *['sub%d' % j for j in range(i + 1)] + ['file.txt'])
+                    for i in range(len(names))]))
+
+    def test_unpack_command(self):
+        file = os.path.join(self.download, 'archive.rar')
+        with open(file, 'w') as fd:
+            fd.write('data')
+
+        def unrar(cmd, cwd=None):
+            if cmd[:2] == ['unrar', 'lb']:
+                return ['sub', 'sub/nested.zip'], [], 0
+            os.makedirs(os.path.join(cwd, 'sub'))
+            self.make_nested(['sub/nested.zip'])
+            return [], [], 0
+
+        with patch.object(media, 'popen', side_effect=unrar):
+            download.unpack_download(self.download)
+        self.assertFalse(os.path.exists(file))
+        self.assertFalse(os.path.exists(os.path.join(self.download, 'sub/nested.zip')))
+        self.assertTrue(os.path.exists(os.path.join(self.download, 'sub/sub0/file.txt')))
+
+
+class DownloadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.names = ['movie.name.%d' % i for i in range(6)]
+        self.files = [os.path.join(self.path, n + '.mkv') for n in self.names]
+        for file in self.files:
+            with open(file, 'w') as fd:
+                fd.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_downloads(self):
+        res = [f.file for f in download.downloads(self.path, workers=3)]
+        self.assertEqual(sorted(res), [os.path.join(self.path, n) for n in self.names])
+
+    def test_downloads_unpack_workers(self):
+        stat = {'count': 0, 'max': 0}
+        lock = threading.Lock()
+        unpack_download = download.unpack_download
+
+        def unpack(file):
+            with lock:
+                stat['count'] += 1
+                stat['max'] = max(stat['max'], stat['count'])
+            time.sleep(.1)
+            with lock:
+                stat['count'] -= 1
+            return unpack_download(file)
+
+        with patch.object(download, 'unpack_download', side_effect=unpack):
+            res = list(download.process_downloads(self.files, 4, unpack_workers=2))
+        self.assertEqual(len(res), len(self.names))
+        self.assertEqual(stat['max'], 2)
+
+    def test_downloads_isolation(self):
+        unpack_download = download.unpack_download
+
+        def unpack(file):
+            if 'movie.name.2' in file:
+                raise Exception('unpack error')
+            return unpack_download(file)
+
+        with patch.object(download, 'unpack_download', side_effect=unpack):
+            res = [f.file for f in download.process_downloads(self.files, 3)]
+        self.assertEqual(len(res), len(self.names) - 1)
+        self.assertFalse(os.path.join(self.path, 'movie.name.2') in res)
+
+    def test_downloads_same_clean_name(self):
+        files = []
+        for i, sep in enumerate(' &,!+='):
+            file = os.path.join(self.path, 'Movie%sName.avi' % sep)
+            with open(file, 'w') as fd:
+                fd.write('data%d' % i)
+            files.append(file)
+        get_unique = media.get_unique
+
+        def get_unique_slow(file):
+            res = get_unique(file)
+            time.sleep(.05)
+            return res
+
+        with patch.object(media, 'get_unique', side_effect=get_unique_slow):
+            res = [f.file for f in download.process_downloads(files, len(files))]
+        self.assertEqual(len(set(res)), len(files))
+        data = []
+        for path in res:
+            names = os.listdir(path)
+            self.assertEqual(len(names), 1)
+            with open(os.path.join(path, names[0])) as fd:
+                data.append(fd.read())
+        self.assertEqual(sorted(data), ['data%d' % i for i in range(len(files))])
+
+
+class WatchDownloadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.write('movie.name.2012.mkv')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, close=True):
+        file = os.path.join(self.path, name)
+        if not os.path.exists(os.path.dirname(file)):
+            os.makedirs(os.path.dirname(file))
+        fd = open(file, 'w')
+        fd.write('data')
+        if not close:
+            return fd
+        fd.close()
+
+    def test_watch(self):
+        watch = download.watch_downloads(self.path, quiet_delay=.3)
+        try:
+            res = next(watch)
+            self.assertEqual(res.file, os.path.join(self.path, 'movie.name.2012'))
+
+            timer = threading.Timer(.2, self.write, ['show.name.s01e02.mkv'])
+            timer.start()
+            begin = time.time()
+            res = next(watch)
+            self.assertEqual(res.file, os.path.join(self.path, 'show.name.s01e02'))
+            self.assertTrue(.5 <= time.time() - begin < 2)
+        finally:
+            watch.close()
+
+    def test_watch_large_archive(self):
+        path = os.path.join(self.path, 'item')
+        os.makedirs(path)
+        with zipfile.ZipFile(os.path.join(path, 'archive.zip'), 'w') as zf:
+            for i in range(4000):
+                zf.writestr('file%04d.txt' % i, 'data')
+
+        watch = download.watch_downloads(self.path, quiet_delay=.3)
+        try:
+            res = sorted([next(watch).file, next(watch).file])
+            self.assertEqual(res, [os.path.join(self.path, 'item'),
+                    os.path.join(self.path, 'movie.name.2012')])
+            self.assertEqual(len(os.listdir(path)), 4000)
+
+            timer = threading.Timer(.2, self.write, ['show.name.s01e02.mkv'])
+            timer.start()
+            res = next(watch)
+            self.assertEqual(res.file, os.path.join(self.path, 'show.name.s01e02'))
+        finally:
+            watch.close()
+
+    def test_watch_open(self):
+        watch = download.watch_downloads(self.path, quiet_delay=.3)
+        try:
+            next(watch)
+            fd = self.write('other.movie/other.movie.mkv', close=False)
+            timer = threading.Timer(1, fd.close)
+            timer.start()
+            begin = time.time()
+            res = next(watch)
+            self.assertEqual(res.file, os.path.join(self.path, 'other.movie'))
+            self.assertTrue(time.time() - begin >= 1)
+        finally:
+            watch.close()
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data = dict([('dir/file%d.txt' % i, ('data %d ' % i) * 10000)
+                for i in range(3)])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_zip(self, name):
+        file = os.path.join(self.path, name)
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for member in sorted(self.data):
+                zf.writestr(member, self.data[member])
+        return file
+
+    def make_tar(self, name, members=None):
+        file = os.path.join(self.path, name)
+        with closing(tarfile.open(file, 'w:gz')) as tf:
+            for member in members or sorted(self.data):
+                info = tarfile.TarInfo(member)
+                info.size = len(self.data[sorted(self.data)[0]])
+                tf.addfile(info, StringIO(self.data[sorted(self.data)[0]]))
+        return file
+
+    def check_files(self, members=None):
+        for member in members or self.data:
+            with open(os.path.join(self.path, member)) as fd:
+                self.assertEqual(fd.read(), self.data[member])
+
+    def test_unpack_zip(self):
+        file = self.make_zip('archive.zip')
+        progress = Mock()
+        archive = get_file(file)
+        self.assertEqual(archive.type, 'archive')
+        self.assertEqual(archive.unpack(progress=progress), [file])
+        self.check_files()
+        self.assertFalse(os.path.exists(file))
+        self.assertEqual(progress.call_count, 3)
+        progress.assert_called_with(os.path.join(self.path, 'dir/file2.txt'), 3, 3)
+
+    def test_unpack_zip_corrupt(self):
+        file = self.make_zip('archive.zip')
+        with zipfile.ZipFile(file) as zf:
+            member = zf.getinfo('dir/file1.txt')
+        with open(file, 'r+b') as fd:
+            fd.seek(member.header_offset + 30 + len(member.filename) + 10)
+            fd.write('corrupt')
+
+        self.assertRaises(ArchiveError, unpack_zip, file, self.path)
+        self.check_files(['dir/file0.txt', 'dir/file2.txt'])
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'dir/file1.txt')))
+
+        # Keep the source of partially extracted archives
+        os.remove(os.path.join(self.path, 'dir/file2.txt'))
+        get_file(file).unpack()
+        self.check_files(['dir/file0.txt', 'dir/file2.txt'])
+        self.assertTrue(os.path.exists(file))
+
+    def test_unpack_zip_unreadable(self):
+        file = self.make_zip('archive.zip')
+        with open(file, 'r+b') as fd:
+            fd.truncate(os.path.getsize(file) / 2)
+
+        self.assertRaises(BadArchiveError, unpack_zip, file, self.path)
+        get_file(file).unpack()
+        self.assertFalse(os.path.exists(file))
+
+    def test_unpack_zip_unsupported(self):
+        file = os.path.join(self.path, 'archive.zip')
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_STORED) as zf:
+            zf.writestr('file0.txt', 'data')
+            zf.writestr('file1.txt', 'data')
+        # Set the second member compression to deflate64
+        with open(file, 'rb') as fd:
+            data = fd.read()
+        pos = data.index('PK\x03\x04', 1) + 8
+        data = data[:pos] + '\x09\x00' + data[pos + 2:]
+        pos = data.rindex('PK\x01\x02') + 10
+        data = data[:pos] + '\x09\x00' + data[pos + 2:]
+        with open(file, 'wb') as fd:
+            fd.write(data)
+
+        self.assertRaises(UnsupportedArchiveError, unpack_zip, file, self.path)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'file0.txt')))
+        with patch.object(media, 'popen', return_value=([], [], 0)) as mock_popen:
+            self.assertEqual(get_file(file).unpack(remove_src=False), [file])
+        mock_popen.assert_called_once_with(ARCHIVE_DEF['.zip'] + [file], cwd=self.path)
+        self.assertTrue(os.path.exists(file))
+
+    def test_unpack_tar(self):
+        file = self.make_tar('archive.tar.gz')
+        archive = get_file(file)
+        self.assertEqual(archive.type, 'archive')
+        self.assertEqual(archive.unpack(), [file])
+        self.assertFalse(os.path.exists(file))
+        with open(os.path.join(self.path, 'dir/file2.txt')) as fd:
+            self.assertEqual(fd.read(), self.data['dir/file0.txt'])
+
+    def test_unpack_tar_unsafe(self):
+        file = self.make_tar('archive.tgz', members=['../file.txt', 'dir/file0.txt'])
+        unpack_tar(file, self.path)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.path), 'file.txt')))
+        self.check_files(['dir/file0.txt'])
+
+    def test_unpack_tar_truncated(self):
+        file = self.make_tar('archive.tar.gz')
+        with open(file, 'r+b') as fd:
+            fd.truncate(os.path.getsize(file) / 2)
+        get_file(file).unpack(remove_src=False)
+        self.assertFalse(os.path.exists(file))
+
+    def test_unpack_command(self):
+        file = os.path.join(self.path, 'archive.rar')
+        with open(file, 'w') as fd:
+            fd.write('data')
+        with patch.object(media, 'popen', return_value=([], [], 0)) as mock_popen:
+            get_file(file).unpack(remove_src=False)
+        mock_popen.assert_called_once_with(ARCHIVE_DEF['.rar'] + [file], cwd=self.path)
+        self.assertTrue(os.path.exists(file))
+
+    def test_unpack_command_progress(self):
+        file = os.path.join(self.path, 'archive.rar')
+        os.makedirs(os.path.join(self.path, 'dir/deeper'))
+        names = ['big file 1.mkv', 'dir/file2.txt', 'dir/deeper/file3.txt']
+        files = sorted(os.path.join(self.path, n) for n in names)
+
+        def popen(cmd, cwd=None, stdout=None, members=None):
+            if cmd == ARCHIVE_DEF['.rar'] + [file]:
+                for name in names:
+                    with open(os.path.join(cwd, name), 'w') as fd:
+                        fd.write('data')
+                return stdout, [], 0
+            elif cmd == media.ARCHIVE_LIST_DEF['.rar'] + [file]:
+                return (members, [], 0) if members else (None, None, None)
+
+        # Files listed in the command output, with the unrar progress
+        stdout = ['', 'Extracting from %s' % file, '',
+                'Creating    dir                                                       OK',
+                'Extracting  big file 1.mkv                                              '
+                    '\x08\x08\x08\x08  5%\x08\x08\x08\x08 55%\x08\x08\x08\x08\x08  OK ',
+                'Extracting  dir/file2.txt                                               '
+                    '\x08\x08\x08\x08100%\x08\x08\x08\x08\x08  OK ',
+                'Extracting  dir/deeper/file3.txt                                        '
+                    '\x08\x08\x08\x08  0%\x08\x08\x08\x08\x08  OK ',
+                'All OK']
+        for stdout, members in ((stdout, None), ([], names)):
+            with open(file, 'w') as fd:
+                fd.write('data')
+            progress = Mock()
+            with patch.object(media, 'popen',
+                        side_effect=lambda cmd, cwd=None: popen(cmd, cwd, stdout, members)), \
+                    patch.object(media, '_walk', wraps=media._walk) as mock_walk:
+                get_file(file).unpack(progress=progress)
+            self.assertEqual([c[0][0] for c in progress.call_args_list], files)
+            self.assertEqual(mock_walk.call_count, 0)
+
+
+class DirTypeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dirs = [self.path]
+        for dir in ('movie', 'movie/subs', 'music', 'music/cd1', 'music/cd2'):
+            self.dirs.append(os.path.join(self.path, dir))
+            os.makedirs(self.dirs[-1])
+        for file, size in (('movie/movie.avi', 50), ('movie/movie.nfo', 1),
+                ('movie/subs/movie.srt', 2), ('movie/subs/movie.en.srt', 2),
+                ('music/cd1/01.mp3', 5), ('music/cd1/02.mp3', 5),
+                ('music/cd2/01.mp3', 5), ('music/cover.jpg', 3)):
+            self._write(file, size)
+        media._dir_types_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, file, size):
+        with open(os.path.join(self.path, file), 'w') as fd:
+            fd.write('x' * size * 1024)
+
+    def _get_type_reference(self, path):
+        type_stat = {}
+        for path_, dirs, files_ in os.walk(path):
+            for file in files_:
+                file = os.path.join(path_, file)
+                file_type = get_file_type(file)
+                if file_type:
+                    type_stat.setdefault(file_type, [0, 0])
+                    type_stat[file_type][0] += 1
+                    type_stat[file_type][1] += os.stat(file).st_size / 1024
+        stat = sorted([(v[0] * v[1], t) for t, v in type_stat.items()])
+        if stat:
+            return stat[-1][1]
+
+    def _check(self):
+        for dir in self.dirs:
+            self.assertEqual(get_type(dir), self._get_type_reference(dir), dir)
+
+    def test_get_type(self):
+        self._check()
+        self.assertEqual(get_type(self.path), 'video')
+        self.assertEqual(get_type(os.path.join(self.path, 'music')), 'audio')
+
+    def test_cache(self):
+        self._check()
+        with patch.object(media, '_scandir', wraps=media._scandir) as mock_scandir:
+            self._check()
+            self.assertEqual(mock_scandir.call_count, 0)
+
+            self._write('music/cd2/02.mp3', 50)
+            self._write('music/cd2/03.mp3', 50)
+            self._check()
+            self.assertEqual(get_type(self.path), 'audio')
+            self.assertEqual(set([c[0][0] for c in mock_scandir.call_args_list]),
+                    set([os.path.join(self.path, 'music/cd2')]))
+
+
+class FileTypeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        exts = list(mimetypes.types_map) + list(mimetypes.suffix_map) \
+                + list(mimetypes.encodings_map) + ['', '.xyz', '.SRT', '.Rar', '.AVI', '.avi.gz']
+        self.fixtures = ['file%s' % e for e in exts] + ['dir/file.name%s' % e for e in exts]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _get_file_type_reference(self, file):
+        ext = os.path.splitext(file)[1].lower()
+        if ext in media.ARCHIVE_DEF or ext in media.TAR_EXTS:
+            return 'archive'
+        elif ext in ('.srt', '.ssa', '.sub'):
+            return 'subtitles'
+        file_type = mimetypes.guess_type(file)[0]
+        if file_type == 'application/x-tar':
+            return 'archive'
+        elif file_type:
+            return file_type.split('/')[0]
+
+    def test_file_type(self):
+        for file in self.fixtures:
+            self.assertEqual(get_file_type(file), self._get_file_type_reference(file), file)
+
+    def test_sniff(self):
+        for data, ext, expected in (
+                ('\x1a\x45\xdf\xa3\x01\x00', '', 'video'),
+                ('RIFF\x00\x00\x00\x00AVI LIST', '.txt', 'video'),
+                ('ID3\x03\x00', '.avi', 'audio'),
+                ('Rar!\x1a\x07\x00', '.r00', 'archive'),
+                ('some text', '.srt', 'subtitles'),
+                ('', '', None),
+                ):
+            file = os.path.join(self.path, 'file%s' % ext)
+            with open(file, 'wb') as fd:
+                fd.write(data)
+            self.assertEqual(get_file_type(file, sniff=True), expected, repr(data))
+            os.remove(file)
+
+
+class FileInfoIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = []
+        for i in range(5):
+            self.files.append(os.path.join(self.path, 'show.name.s01e0%d.avi' % i))
+            with open(self.files[-1], 'w') as fd:
+                fd.write('x' * 1024)
+        Media.set_info_index(os.path.join(self.path, 'index.db'))
+
+    def tearDown(self):
+        Media.set_info_index(None)
+        shutil.rmtree(self.path)
+
+    @patch('filetools.media.get_info')
+    def test_get_file_info(self, mock_get_info):
+        mock_get_info.side_effect = lambda file: {'duration': 60}
+        for i in range(2):
+            for file in self.files:
+                info = get_file(file).get_file_info()
+                self.assertEqual(info['duration'], 60)
+                self.assertEqual(info['name'], 'show name')
+        self.assertEqual(mock_get_info.call_count, len(self.files))
+
+        with open(self.files[0], 'a') as fd:
+            fd.write('x')
+        get_file(self.files[0]).get_file_info()
+        self.assertEqual(mock_get_info.call_count, len(self.files) + 1)
+
+    @patch('filetools.media.get_info')
+    def test_get_file_info_failed(self, mock_get_info):
+        mock_get_info.return_value = None
+        for i in range(2):
+            info = get_file(self.files[0]).get_file_info()
+            self.assertEqual(info['name'], 'show name')
+            self.assertFalse('duration' in info)
+        self.assertEqual(mock_get_info.call_count, 2)
+        self.assertEqual(Media.info_index.get(self.files[0]), None)
+
+    def test_many(self):
+        index = FileInfoIndex(os.path.join(self.path, 'index_many.db'))
+        index.set_many([(f, {'file': f}) for f in self.files[:3]])
+        os.remove(self.files[0])
+        res = index.get_many(self.files)
+        self.assertEqual(res, dict([(f, {'file': f}) for f in self.files[1:3]]))
+        index.close()
+
+
+class MediainfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        make_mediainfo_stub(self.path)
+        self.files = make_media_files(self.path, 12)
+        self.env = patch.dict(os.environ, {'PATH': '%s:%s' % (self.path, os.environ['PATH'])})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.path)
+
+    def test_get_info(self):
+        res = mediainfo.get_info(self.files[3])
+        self.assertEqual(res['duration'], 60)
+        self.assertEqual(res['artist'], 'artist name')
+        self.assertEqual(res['video_codec'], 'avc')
+        self.assertEqual(res['audio_bitrate'], 128000)
+
+    def test_parse_lines(self):
+        lines = ['General', 'Complete name : /data/a:b.mkv', 'Format : Matroska',
+                'Duration : 60000', 'Duration : 00:01:00.000', '',
+                'Audio #1', 'Codec : AAC', 'Channel(s) : 2', '',
+                'General', 'Complete name : /data/c.mkv']
+        res = list(mediainfo._parse_lines(lines))
+        self.assertEqual(res, [
+                {'general': {'complete name': '/data/a:b.mkv', 'duration': '60000'},
+                    'audio #1': {'codec': 'aac'}},
+                {'general': {'complete name': '/data/c.mkv'}},
+                ])
+
+        res = list(mediainfo._parse_lines(lines, fields=None))
+        self.assertEqual(res[0]['general']['format'], 'matroska')
+        self.assertEqual(res[0]['audio #1']['channel(s)'], '2')
+
+    def test_get_info_many(self):
+        expected = dict([(f, mediainfo.get_info(f)) for f in self.files])
+        with patch.object(mediainfo, 'Command', wraps=mediainfo.Command) as mock_popen:
+            res = mediainfo.get_info_many(self.files, batch_size=5)
+        self.assertEqual(res, expected)
+        self.assertEqual(mock_popen.call_count, 3)
+
+    def test_get_info_many_fallback(self):
+        files = self.files[:4] + [os.path.join(self.path, 'missing.mkv')]
+        expected = dict([(f, mediainfo.get_info(f)) for f in files])
+        self.assertEqual(expected[files[-1]], None)
+        with patch.object(mediainfo, 'Command', wraps=mediainfo.Command) as mock_popen:
+            res = mediainfo.get_info_many(files)
+        self.assertEqual(res, expected)
+        self.assertEqual(mock_popen.call_count, 1 + len(files))
+
+    def test_get_info_concurrent(self):
+        expected = dict([(f, mediainfo.get_info(f)) for f in self.files])
+        res = list(mediainfo.get_info_concurrent(self.files, max_workers=3))
+        self.assertEqual(len(res), len(self.files))
+        self.assertEqual(dict(res), expected)
+
+    def test_get_info_concurrent_timeout(self):
+        file = os.path.join(self.path, 'show.slow.mkv')
+        shutil.copy(self.files[0], file)
+        begin = time.time()
+        res = dict(mediainfo.get_info_concurrent([file] + self.files[:2], timeout=1))
+        self.assertTrue(time.time() - begin < 5)
+        self.assertEqual(res[file], None)
+        self.assertEqual(res[self.files[1]]['duration'], 60)
+
+    def test_get_files_info_timeout(self):
+        file = os.path.join(self.path, 'show.slow.s01e05.mkv')
+        shutil.copy(self.files[0], file)
+        Media.set_info_index(os.path.join(self.path, 'index.db'))
+        try:
+            files = [get_file(file), get_file(self.files[1])]
+            res = dict([(f.file, i) for f, i in media.get_files_info(files, timeout=1)])
+            self.assertEqual(res[file]['episode'], '05')
+            self.assertFalse('duration' in res[file])
+            self.assertEqual(Media.info_index.get(file), None)
+            self.assertEqual(Media.info_index.get(self.files[1])['duration'], 60)
+        finally:
+            Media.set_info_index(None)
+
+    def test_get_files_info(self):
+        index_file = os.path.join(self.path, 'index.db')
+        Media.set_info_index(index_file)
+        try:
+            files = list(media.files(self.path, types='video'))
+            expected = dict([(f.file, f._get_file_info()) for f in files])
+            res = dict([(f.file, i) for f, i in media.get_files_info(files)])
+            self.assertEqual(res, expected)
+            self.assertEqual(res[self.files[2]]['episode'], '02')
+
+            with patch.object(media, 'get_info_concurrent') as mock_get:
+                res = dict([(f.file, i) for f, i in media.get_files_info(files)])
+            self.assertEqual(res, expected)
+            self.assertEqual(list(mock_get.call_args[0][0]), [])
+        finally:
+            Media.set_info_index(None)
+
+
 if __name__ == '__main__':
     unittest.main()